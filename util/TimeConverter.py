@@ -3,8 +3,137 @@ from datetime import datetime
 import pytz
 
 class TimeConverter:
+    # Shared UTC tzinfo, reused by every conversion
+    UTC = pytz.UTC
+    
     def __init__(self):
-        pass
+        # Cache of timezone name -> pytz tzinfo, avoids re-reading zone data on every call
+        self._tz_cache = {}
+    
+    def _get_timezone(self, timezone):
+        """Return the cached pytz timezone object for the given name"""
+        tz = self._tz_cache.get(timezone)
+        if tz is None:
+            tz = self._tz_cache.setdefault(timezone, pytz.timezone(timezone))
+        return tz
+    
+    def _get_dst_transition(self, day_start, day_end):
+        """Return the DST transition label for the day spanned by two aware datetimes"""
+        # The UTC offset grows when clocks spring forward and shrinks when they fall back
+        off0 = day_start.utcoffset()
+        off1 = day_end.utcoffset()
+        
+        if off1 > off0:
+            return "DST starts (Spring, losing one hour)"
+        if off1 < off0:
+            return "DST ends (Fall, gaining one hour)"
+        return None
+    
+    def _is_dst_bulk(self, aware_times, local_times, utc_offsets):
+        """
+        Check DST for a series of aware times
+        
+        dst() only changes together with the UTC offset, so it is evaluated once
+        per distinct (year, offset) pair and broadcast back to every row
+        """
+        keys = pd.DataFrame({
+            'year': local_times.dt.year.to_numpy(),
+            'offset': utc_offsets.to_numpy()
+        })
+        firsts = keys.drop_duplicates()
+        firsts = firsts.assign(
+            is_dst=[aware_times.iloc[i].dst() != pd.Timedelta(0) for i in firsts.index]
+        )
+        is_dst = keys.merge(firsts, on=['year', 'offset'], how='left')['is_dst']
+        return pd.Series(is_dst.to_numpy(dtype=bool), index=local_times.index)
+    
+    def _map_dst_transitions(self, days, day_bounds):
+        """Compute the DST transition once per distinct day and map it onto every row"""
+        transitions = {
+            day: self._get_dst_transition(*day_bounds(day))
+            for day in days.drop_duplicates()
+        }
+        dst_transition = days.map(transitions).astype(object)
+        return dst_transition.where(dst_transition.notna(), None)
+    
+    def local_to_utc_bulk(self, local_times, timezone):
+        """
+        Convert a series of local times to UTC and check for DST
+        
+        Parameters:
+        -----------
+        local_times : pd.Series or array-like
+            Local times, format: "YYYY-MM-DD HH:MM" or datetime values
+        timezone : str
+            Timezone name, e.g. "Europe/London"
+            
+        Returns:
+        --------
+        pd.DataFrame
+            One row per input time with columns input_local_time, utc_time,
+            is_dst and dst_transition
+        """
+        local_times = pd.Series(pd.to_datetime(local_times))
+        tz = self._get_timezone(timezone)
+        
+        # Localize and convert the whole series at once
+        local_aware = local_times.dt.tz_localize(tz, ambiguous='raise', nonexistent='raise')
+        utc_times = local_aware.dt.tz_convert(self.UTC).dt.tz_localize(None)
+        
+        # Check if it's DST
+        is_dst = self._is_dst_bulk(local_aware, local_times, local_times - utc_times)
+        
+        # Check if it's conversion day
+        one_day = pd.Timedelta(days=1) - pd.Timedelta(microseconds=1)
+        dst_transition = self._map_dst_transitions(
+            local_times.dt.normalize(),
+            lambda day: (tz.localize(day, is_dst=None), tz.localize(day + one_day, is_dst=None))
+        )
+        
+        return pd.DataFrame({
+            'input_local_time': local_times,
+            'utc_time': utc_times,
+            'is_dst': is_dst,
+            'dst_transition': dst_transition
+        })
+    
+    def utc_to_local_bulk(self, utc_times, timezone):
+        """
+        Convert a series of UTC times to local time and check for DST
+        
+        Parameters:
+        -----------
+        utc_times : pd.Series or array-like
+            UTC times, format: "YYYY-MM-DD HH:MM" or datetime values
+        timezone : str
+            Target timezone name, e.g. "Europe/London"
+            
+        Returns:
+        --------
+        pd.DataFrame
+            One row per input time with columns input_utc_time, local_time,
+            is_dst and dst_transition
+        """
+        utc_times = pd.Series(pd.to_datetime(utc_times))
+        tz = self._get_timezone(timezone)
+        
+        # Convert the whole series at once
+        local_aware = utc_times.dt.tz_localize(self.UTC).dt.tz_convert(tz)
+        local_times = local_aware.dt.tz_localize(None)
+        
+        # Check if it's DST
+        is_dst = self._is_dst_bulk(local_aware, local_times, local_times - utc_times)
+        
+        # Check if it's conversion day: the input day is a UTC day, which always spans
+        # 24 hours, so no transition is reported on this path
+        dst_transition = pd.Series(None, index=utc_times.index, dtype=object)
+        
+        return pd.DataFrame({
+            'input_utc_time': utc_times,
+            'local_time': local_times,
+            'is_dst': is_dst,
+            'dst_transition': dst_transition
+        })
     
     def local_to_utc(self, local_time, timezone):
         """
@@ -25,40 +154,15 @@ class TimeConverter:
         # Ensure input is a datetime object
         if isinstance(local_time, str):
             local_time = pd.to_datetime(local_time)
-            
-        # Get timezone object
-        tz = pytz.timezone(timezone)
-        
-        # Check if it's DST
-        local_time_aware = tz.localize(local_time, is_dst=None)
-        is_dst = local_time_aware.dst() != pd.Timedelta(0)
         
-        # Convert to UTC
-        utc_time = local_time_aware.astimezone(pytz.UTC)
-        
-        # Check if it's conversion day
-        day_start = local_time.replace(hour=0, minute=0, second=0, microsecond=0)
-        day_end = local_time.replace(hour=23, minute=59, second=59, microsecond=999999)
-        
-        day_hours = pd.date_range(
-            start=tz.localize(day_start, is_dst=None),
-            end=tz.localize(day_end, is_dst=None),
-            freq='h'
-        )
-        
-        dst_transition = None
-        if len(day_hours) != 24:
-            if len(day_hours) == 23:
-                dst_transition = "DST starts (Spring, losing one hour)"
-            elif len(day_hours) == 25:
-                dst_transition = "DST ends (Fall, gaining one hour)"
+        result = self.local_to_utc_bulk([local_time], timezone).iloc[0]
         
         return {
             'input_local_time': local_time,
             'timezone': timezone,
-            'utc_time': utc_time.replace(tzinfo=None),
-            'is_dst': is_dst,
-            'dst_transition': dst_transition
+            'utc_time': result['utc_time'],
+            'is_dst': bool(result['is_dst']),
+            'dst_transition': result['dst_transition']
         }
     
     def utc_to_local(self, utc_time, timezone):
@@ -80,42 +184,15 @@ class TimeConverter:
         # Ensure input is a datetime object
         if isinstance(utc_time, str):
             utc_time = pd.to_datetime(utc_time)
-            
-        # Add UTC timezone information
-        utc_time_aware = pytz.UTC.localize(utc_time)
         
-        # Get target timezone object
-        tz = pytz.timezone(timezone)
-        
-        # Convert to local time
-        local_time = utc_time_aware.astimezone(tz)
-        
-        # Check if it's DST
-        is_dst = local_time.dst() != pd.Timedelta(0)
-        
-        # Check if it's conversion day
-        utc_day_start = utc_time.replace(hour=0, minute=0, second=0, microsecond=0)
-        utc_day_end = utc_time.replace(hour=23, minute=59, second=59, microsecond=999999)
-        
-        local_hours = pd.date_range(
-            start=pytz.UTC.localize(utc_day_start).astimezone(tz),
-            end=pytz.UTC.localize(utc_day_end).astimezone(tz),
-            freq='h'
-        )
-        
-        dst_transition = None
-        if len(local_hours) != 24:
-            if len(local_hours) == 23:
-                dst_transition = "DST starts (Spring, losing one hour)"
-            elif len(local_hours) == 25:
-                dst_transition = "DST ends (Fall, gaining one hour)"
+        result = self.utc_to_local_bulk([utc_time], timezone).iloc[0]
         
         return {
             'input_utc_time': utc_time,
             'timezone': timezone,
-            'local_time': local_time.replace(tzinfo=None),
-            'is_dst': is_dst,
-            'dst_transition': dst_transition
+            'local_time': result['local_time'],
+            'is_dst': bool(result['is_dst']),
+            'dst_transition': result['dst_transition']
         }
 
 def main():
@@ -1,7 +1,10 @@
 import xarray as xr
 import geopandas as gpd
+import pyogrio
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from shapely.geometry import box, Polygon
 from pathlib import Path
 import warnings
@@ -10,36 +13,42 @@ warnings.filterwarnings('ignore')
 
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 class WeatherGridProcessor:
-    def __init__(self, city_name, era5_root="G:/002_Data/007_ERA5", processed_dir="data/processed"):
+    def __init__(self, city_name, era5_root="G:/002_Data/007_ERA5", processed_dir="data/processed", debug=False):
         """
         初始化处理器
         city_name: 城市名称
         era5_root: ERA5数据根目录
+        debug: 是否保存城市边界框和ERA5网格的调试GeoJSON
         """
         self.city_name = city_name
+        self.debug = debug
         self.era5_root = Path(era5_root)
         self.data_dir = Path(f"data/001_Integrated Urban Traffic-Flood Dataset/{city_name}")
         self.processed_dir = Path(f"{processed_dir}/{city_name}")
         self.processed_dir.mkdir(parents=True, exist_ok=True)
         
+        # 城市边界缓存，每个城市只读取一次路网文件
+        self._city_bounds = None
+        
         # 断点续传相关
-        self.progress_file = self.processed_dir / 'processing_progress.json'
+        self.progress_file = self.processed_dir / 'processing_progress.ndjson'
         self.processed_dates = self._load_progress()
     
     def _load_progress(self):
         """加载处理进度"""
-        if self.progress_file.exists():
-            with open(self.progress_file, 'r') as f:
-                return set(json.load(f))
-        return set()
+        return load_progress_log(self.progress_file)
     
     def _save_progress(self, date):
-        """保存处理进度"""
+        """保存处理进度（每个日期追加一行）"""
         self.processed_dates.add(str(date))
-        with open(self.progress_file, 'w') as f:
-            json.dump(list(self.processed_dates), f)
+        append_progress_log(self.progress_file, date)
+    
+    def _compact_progress(self):
+        """压缩进度文件，去除重复行"""
+        compact_progress_log(self.progress_file, self.processed_dates)
     
     def get_target_dates(self):
         """获取需要处理的日期列表"""
@@ -50,29 +59,44 @@ class WeatherGridProcessor:
         df = pd.read_csv(rainfall_file)
         return df[df['city'] == self.city_name]['date'].unique()
     
-    def process_all_dates(self):
-        """处理所有目标日期的数据"""
-        target_dates = self.get_target_dates()
+    def process_all_dates(self, n_workers=None):
+        """
+        处理所有目标日期的数据
+        n_workers: 并行处理的进程数，默认使用全部CPU核心；设为1时在当前进程中顺序处理
+        """
+        target_dates = pd.Series(self.get_target_dates())
         
-        for date in target_dates:
-            # 确保日期格式正确
-            try:
-                formatted_date = pd.to_datetime(date).strftime('%Y-%m-%d')
-                # 检查是否已处理
-                if formatted_date in self.processed_dates:
-                    print(f"日期 {formatted_date} 已处理，跳过")
-                    continue
-                
-                # 构建GRIB文件路径
-                grib_file = self.era5_root / f"era5_rainfall_{formatted_date}.grib"
-                
-                if not grib_file.exists():
-                    print(f"警告：找不到日期 {formatted_date} 的GRIB文件")
-                    continue
-                
+        # 一次性解析并格式化所有日期
+        parsed_dates = pd.to_datetime(target_dates, errors='coerce')
+        for date in target_dates[parsed_dates.isna()]:
+            print(f"日期格式错误 {date}")
+        formatted_dates = parsed_dates.dropna().dt.strftime('%Y-%m-%d').unique()
+        
+        # 收集待处理的日期
+        pending = []
+        for formatted_date in formatted_dates:
+            # 检查是否已处理
+            if formatted_date in self.processed_dates:
+                print(f"日期 {formatted_date} 已处理，跳过")
+                continue
+            
+            # 构建GRIB文件路径
+            grib_file = self.era5_root / f"era5_rainfall_{formatted_date}.grib"
+            
+            if not grib_file.exists():
+                print(f"警告：找不到日期 {formatted_date} 的GRIB文件")
+                continue
+            
+            pending.append((formatted_date, str(grib_file)))
+        
+        if n_workers is None:
+            n_workers = os.cpu_count() or 1
+        
+        if n_workers == 1:
+            for formatted_date, grib_file in pending:
                 try:
                     print(f"处理日期: {formatted_date}")
-                    grid_gdf, rainfall_df = self.process_grib_data(str(grib_file))
+                    grid_gdf, rainfall_df = self.process_grib_data(grib_file)
                     print(f"日期 {formatted_date} 处理完成")
                     
                     # 保存进度
@@ -81,17 +105,52 @@ class WeatherGridProcessor:
                 except Exception as e:
                     print(f"处理日期 {formatted_date} 时出错: {str(e)}")
                     continue
-                
+        else:
+            # 城市边界在主进程中读取一次，传给每个子进程，避免每个日期重新读取路网文件
+            try:
+                city_bounds = self.get_city_bounds()
             except Exception as e:
-                print(f"日期格式错误 {date}: {str(e)}")
-                continue
+                print(f"读取城市边界时出错: {str(e)}")
+                city_bounds = None
+            
+            # 每个日期相互独立，交给子进程处理；每个子进程只创建一个处理器实例
+            # 进度只在主进程中保存
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=_init_grib_worker,
+                initargs=(self.city_name, self.era5_root, self.processed_dir.parent, self.debug, city_bounds)
+            ) as executor:
+                futures = {
+                    executor.submit(_process_grib_file, grib_file): formatted_date
+                    for formatted_date, grib_file in pending
+                }
+                
+                for future in as_completed(futures):
+                    formatted_date = futures[future]
+                    try:
+                        future.result()
+                        print(f"日期 {formatted_date} 处理完成")
+                        
+                        # 保存进度
+                        self._save_progress(formatted_date)
+                        
+                    except Exception as e:
+                        print(f"处理日期 {formatted_date} 时出错: {str(e)}")
+                        continue
+        
+        self._compact_progress()
     
     def get_city_bounds(self):
         """获取城市边界"""
-        network_file = self.data_dir / "selected_network_4326.geojson"
-        road_network = gpd.read_file(network_file)
-        bounds = road_network.total_bounds  # (minx, miny, maxx, maxy)
-        return bounds
+        if self._city_bounds is None:
+            network_file = self.data_dir / "selected_network_4326.geojson"
+            # 只读取每个要素的外包框，不构建几何对象和属性表
+            _, feature_bounds = pyogrio.read_bounds(network_file)
+            self._city_bounds = np.array([
+                feature_bounds[0].min(), feature_bounds[1].min(),
+                feature_bounds[2].max(), feature_bounds[3].max()
+            ])  # (minx, miny, maxx, maxy)
+        return self._city_bounds
     
     def create_era5_grid(self, ds):
         """基于ERA5数据创建网格"""
@@ -99,11 +158,6 @@ class WeatherGridProcessor:
         lons = ds.longitude.values
         lats = ds.latitude.values
         
-        # 创建网格多边形
-        grid_cells = []
-        grid_ids = []
-        grid_id = 0
-        
         # ERA5网格的分辨率
         lon_res = np.abs(lons[1] - lons[0])
         lat_res = np.abs(lats[1] - lats[0])
@@ -111,26 +165,30 @@ class WeatherGridProcessor:
         print(f"ERA5网格分辨率: 经度 {lon_res:.4f}°, 纬度 {lat_res:.4f}°")
         print(f"近似距离: {lon_res * 111} km x {lat_res * 111} km")
         
-        for lon in lons:
-            for lat in lats:
-                # 创建网格单元（考虑到ERA5的网格中心点）
-                minx = lon - lon_res/2
-                maxx = lon + lon_res/2
-                miny = lat - lat_res/2
-                maxy = lat + lat_res/2
-                
-                polygon = box(minx, miny, maxx, maxy)
-                grid_cells.append(polygon)
-                grid_ids.append(grid_id)
-                grid_id += 1
+        # 网格中心点（经度为外层、纬度为内层，保持grid_id顺序不变）
+        lon_grid, lat_grid = np.meshgrid(lons, lats, indexing='ij')
+        center_lons = lon_grid.ravel()
+        center_lats = lat_grid.ravel()
         
-        # 创建GeoDataFrame
+        # 每个网格在ERA5经纬度坐标中的整数索引
+        lon_idx, lat_idx = np.meshgrid(np.arange(len(lons)), np.arange(len(lats)), indexing='ij')
+        
+        # 创建网格单元（考虑到ERA5的网格中心点）
+        minx = center_lons - lon_res/2
+        maxx = center_lons + lon_res/2
+        miny = center_lats - lat_res/2
+        maxy = center_lats + lat_res/2
+        grid_cells = [box(*bounds) for bounds in zip(minx, miny, maxx, maxy)]
+        
+        # 创建GeoDataFrame（中心点即质心，面积为常数）
         grid_gdf = gpd.GeoDataFrame({
-            'grid_id': grid_ids,
+            'grid_id': np.arange(len(grid_cells)),
             'geometry': grid_cells,
-            'longitude': [p.centroid.x for p in grid_cells],
-            'latitude': [p.centroid.y for p in grid_cells],
-            'area': [p.area for p in grid_cells]
+            'longitude': center_lons,
+            'latitude': center_lats,
+            'lon_idx': lon_idx.ravel(),
+            'lat_idx': lat_idx.ravel(),
+            'area': np.full(len(grid_cells), lon_res * lat_res)
         }, crs="EPSG:4326")
         return grid_gdf
     
@@ -172,83 +230,113 @@ class WeatherGridProcessor:
         city_box = box(*converted_bounds)
         # print(f"转换后的城市边界框: {city_box.bounds}")
         
-        # 保存调试信息
-        city_box_gdf = gpd.GeoDataFrame(geometry=[city_box], crs="EPSG:4326")
-        city_box_gdf.to_file(self.processed_dir / 'city_box.geojson', driver='GeoJSON')
-        grid_gdf.to_file(self.processed_dir / 'era5_grid.geojson', driver='GeoJSON')
+        # 保存调试信息（仅在调试模式下）
+        if self.debug:
+            city_box_gdf = gpd.GeoDataFrame(geometry=[city_box], crs="EPSG:4326")
+            city_box_gdf.to_file(self.processed_dir / 'city_box.geojson', driver='GeoJSON')
+            grid_gdf.to_file(self.processed_dir / 'era5_grid.geojson', driver='GeoJSON')
         
-        # 检查相交情况
-        grid_gdf['intersects_city'] = grid_gdf.geometry.intersects(city_box)
-        intersecting_grids = grid_gdf[grid_gdf['intersects_city']]
-        # print(f"相交网格数量: {len(intersecting_grids)}")
+        # 检查相交情况（使用空间索引，只对候选网格做精确判断）
+        intersecting_idx = np.sort(grid_gdf.sindex.query(city_box, predicate='intersects'))
+        # print(f"相交网格数量: {len(intersecting_idx)}")
         
-        if len(intersecting_grids) == 0:
+        if len(intersecting_idx) == 0:
             print("警告：没有网格与城市边界相交！")
             print("ERA5网格范围:", grid_gdf.total_bounds)
             print("转换后的城市边界范围:", city_box.bounds)
             raise ValueError("没有找到相交的网格")
         
-        grid_gdf = intersecting_grids.copy()
-        grid_gdf = grid_gdf.drop(columns=['intersects_city'])
+        # 原地筛选，不额外生成中间副本
+        grid_gdf = grid_gdf.iloc[intersecting_idx].reset_index(drop=True)
         # print(grid_gdf)
         # 重新编号grid_id
         # grid_gdf['grid_id'] = range(len(grid_gdf))
         
-        # 创建时间序列数据
-        time_data = []
+        # 网格中心点坐标，作为向量化选取的索引
+        cell_lon = xr.DataArray(grid_gdf['longitude'].values, dims='cell')
+        cell_lat = xr.DataArray(grid_gdf['latitude'].values, dims='cell')
+        
+        # 覆盖城市网格的最小经纬度索引范围
+        lon_start, lon_stop = grid_gdf['lon_idx'].min(), grid_gdf['lon_idx'].max() + 1
+        lat_start, lat_stop = grid_gdf['lat_idx'].min(), grid_gdf['lat_idx'].max() + 1
+        
+        # 网格由同一数据集生成，可直接按整数索引取值，无需最近邻搜索（索引相对于城市子区域）
+        cell_lon_idx = xr.DataArray(grid_gdf['lon_idx'].values - lon_start, dims='cell')
+        cell_lat_idx = xr.DataArray(grid_gdf['lat_idx'].values - lat_start, dims='cell')
+        
+        # 读取降水类型数据 (edition 2)，整个文件只打开一次
+        try:
+            ds_type = xr.open_dataset(grib_file, engine='cfgrib',
+                                    backend_kwargs={'filter_by_keys': {'edition': 2}})
+        except Exception as e:
+            ds_type = None
         
-        for time in ds_rain.time:
-            time_slice = ds_rain.sel(time=time)
-            base_time = pd.Timestamp(time.values)+ pd.Timedelta(hours=1)
+        try:
+            era5_times = ds_rain.time.values
             
-            for idx, grid_cell in grid_gdf.iterrows():
-                # print(idx)
-                cell_data = time_slice.sel(
-                    longitude=grid_cell.longitude,
-                    latitude=grid_cell.latitude,
-                    method='nearest'
-                )
-                
-                # 获取降水类型数据
+            # cfgrib为惰性读取：只把城市子区域的tp/lsrr一次性读入内存，后续取值都在内存中完成
+            city_rain = ds_rain[['tp', 'lsrr']].isel(
+                longitude=slice(lon_start, lon_stop),
+                latitude=slice(lat_start, lat_stop)
+            ).load()
+            
+            # 一次性选取所有网格单元的降水数据，形状为 (time, step, cell)
+            tp_values = city_rain['tp'].isel(
+                longitude=cell_lon_idx, latitude=cell_lat_idx
+            ).transpose('time', 'step', 'cell').values
+            lsrr_values = city_rain['lsrr'].isel(
+                longitude=cell_lon_idx, latitude=cell_lat_idx
+            ).transpose('time', 'step', 'cell').values
+            
+            # 缺失值（nan）统一置为0，对整个数组原地处理一次；降水量使用float32即可
+            tp_values = np.nan_to_num(tp_values, nan=0.0, copy=False).astype(np.float32)
+            lsrr_values = np.nan_to_num(lsrr_values, nan=0.0, copy=False).astype(np.float32)
+            
+            # 获取降水类型数据，形状为 (time, cell)
+            ptype_values = np.full((len(era5_times), len(grid_gdf)), -1.0, dtype=np.float32)
+            if ds_type is not None:
                 try:
-                    ds_type = xr.open_dataset(grib_file, engine='cfgrib',
-                                            backend_kwargs={'filter_by_keys': {'edition': 2}})
-                    type_data = ds_type.sel(
-                        time=time,
-                        longitude=grid_cell.longitude,
-                        latitude=grid_cell.latitude,
+                    ptype = ds_type['ptype']
+                    ptype_values = ptype.sel(
+                        time=ds_rain.time,
+                        longitude=cell_lon,
+                        latitude=cell_lat,
                         method='nearest'
-                    )
-                    precip_type = float(type_data.ptype.values.item())
-                    ds_type.close()
+                    ).transpose('time', 'cell').values.astype(np.float32)
                 except Exception as e:
-                    precip_type = -1
-                
-                # 处理12小时的预报数据
-                tp_values = cell_data.tp.values
-                lsrr_values = cell_data.lsrr.values
-                
-                # 只处理有效的数据（非nan的值）
-                valid_hours = len(tp_values)
-                # print(valid_hours)
-                for hour in range(valid_hours):
-                    current_time = base_time + pd.Timedelta(hours=hour)
-                    # print(current_time)  # Removed debug print
-                    # 只保留目标日期的数据
-                    if current_time.date() == target_date:
-                        time_data.append({
-                            'datetime': pd.Timestamp(current_time).tz_localize('UTC'),  # Explicitly set UTC timezone
-                            'grid_id': grid_cell.grid_id,
-                            'longitude': grid_cell.longitude,
-                            'latitude': grid_cell.latitude,
-                            'total_precipitation': float(tp_values[hour]) if not np.isnan(tp_values[hour]) else 0.0,
-                            'large_scale_rain_rate': float(lsrr_values[hour]) if not np.isnan(lsrr_values[hour]) else 0.0,
-                            'precipitation_type': precip_type,
-                            'forecast_base_time': pd.Timestamp(base_time).tz_localize('UTC')  # Also set UTC for base_time
-                        })
+                    pass
+        finally:
+            if ds_type is not None:
+                ds_type.close()
+            ds_rain.close()
+        
+        # 按 (time, cell, step) 顺序展开为列式数组
+        n_times, n_steps, n_cells = tp_values.shape
+        shape = (n_times, n_cells, n_steps)
+        base_times = era5_times + np.timedelta64(1, 'h')
+        step_hours = np.arange(n_steps) * np.timedelta64(1, 'h')
+        valid_times = base_times[:, None, None] + step_hours[None, None, :]
+        
+        # 只保留目标日期的数据：对整个 (time, cell, step) 矩阵做一次datetime64[D]比较
+        in_target_date = np.broadcast_to(
+            valid_times.astype('datetime64[D]') == np.datetime64(target_date), shape
+        )
         
         # 创建数据框
-        rainfall_df = pd.DataFrame(time_data)
+        rainfall_df = pd.DataFrame({
+            'datetime': np.broadcast_to(valid_times, shape)[in_target_date],
+            'grid_id': np.broadcast_to(grid_gdf['grid_id'].values.astype(np.int32)[None, :, None], shape)[in_target_date],
+            'longitude': np.broadcast_to(grid_gdf['longitude'].values[None, :, None], shape)[in_target_date],
+            'latitude': np.broadcast_to(grid_gdf['latitude'].values[None, :, None], shape)[in_target_date],
+            'total_precipitation': tp_values.transpose(0, 2, 1)[in_target_date],
+            'large_scale_rain_rate': lsrr_values.transpose(0, 2, 1)[in_target_date],
+            'precipitation_type': np.broadcast_to(ptype_values[:, :, None], shape)[in_target_date],
+            'forecast_base_time': np.broadcast_to(base_times[:, None, None], shape)[in_target_date]
+        })
+        
+        # 过滤后一次性设置UTC时区
+        rainfall_df['datetime'] = rainfall_df['datetime'].dt.tz_localize('UTC')
+        rainfall_df['forecast_base_time'] = rainfall_df['forecast_base_time'].dt.tz_localize('UTC')
         
         # 检查是否有缺失的小时数据
         all_hours = pd.date_range(
@@ -265,14 +353,55 @@ class WeatherGridProcessor:
         output_dir = self.processed_dir / 'weather'
         output_dir.mkdir(parents=True, exist_ok=True)
         
-        # 保存网格信息
-        grid_gdf.to_parquet(output_dir / 'grid_info.parquet')
+        # 保存网格信息（先写临时文件再替换，避免并行处理时互相覆盖到一半）
+        grid_info_tmp = output_dir / f'grid_info.{os.getpid()}.parquet'
+        grid_gdf.to_parquet(grid_info_tmp)
+        os.replace(grid_info_tmp, output_dir / 'grid_info.parquet')
         
         # 保存降水数据，使用文件名中的日期
-        rainfall_df.to_parquet(output_dir / f'hourly_rainfall_{target_date}.parquet')
+        pq.write_table(
+            pa.Table.from_pandas(rainfall_df, preserve_index=False),
+            output_dir / f'hourly_rainfall_{target_date}.parquet',
+            compression='zstd'
+        )
         
         return grid_gdf, rainfall_df
 
+def load_progress_log(progress_file):
+    """读取追加式进度文件（每行一个JSON值），兼容旧版的JSON列表进度文件"""
+    progress_file = Path(progress_file)
+    if progress_file.exists():
+        with open(progress_file, 'r') as f:
+            return {str(json.loads(line)) for line in f if line.strip()}
+    legacy_file = progress_file.with_suffix('.json')
+    if legacy_file.exists():
+        with open(legacy_file, 'r') as f:
+            return {str(value) for value in json.load(f)}
+    return set()
+
+def append_progress_log(progress_file, value):
+    """向进度文件追加一条记录"""
+    with open(progress_file, 'a') as f:
+        f.write(json.dumps(str(value)) + '\n')
+
+def compact_progress_log(progress_file, values):
+    """用去重后的记录重写进度文件"""
+    with open(progress_file, 'w') as f:
+        f.writelines(json.dumps(value) + '\n' for value in sorted(values))
+
+# 子进程中的处理器实例，由_init_grib_worker在进程启动时创建一次
+_worker_processor = None
+
+def _init_grib_worker(city_name, era5_root, processed_dir, debug, city_bounds):
+    """子进程初始化：创建处理器实例，并填入主进程读取的城市边界"""
+    global _worker_processor
+    _worker_processor = WeatherGridProcessor(city_name, era5_root, processed_dir, debug)
+    _worker_processor._city_bounds = city_bounds
+
+def _process_grib_file(grib_file):
+    """在子进程中用该进程的处理器实例处理单个GRIB文件"""
+    _worker_processor.process_grib_data(grib_file)
+
 def main():
     # 设置数据目录
     city_dir = Path('data/001_Integrated Urban Traffic-Flood Dataset')
@@ -280,13 +409,10 @@ def main():
     output_dir = Path('data/processed/era5_city')
     
     # 创建全局进度文件
-    global_progress_file = city_dir / 'global_processing_progress.json'
+    global_progress_file = city_dir / 'global_processing_progress.ndjson'
     
     # 加载全局进度
-    processed_cities = set()
-    if global_progress_file.exists():
-        with open(global_progress_file, 'r') as f:
-            processed_cities = set(json.load(f))
+    processed_cities = load_progress_log(global_progress_file)
     
     # 获取所有城市
     cities = [city for city in os.listdir(city_dir) if (city_dir / city).is_dir()]
@@ -311,8 +437,7 @@ def main():
                 
                 # 更新并保存全局进度
                 processed_cities.add(city)
-                with open(global_progress_file, 'w') as f:
-                    json.dump(list(processed_cities), f)
+                append_progress_log(global_progress_file, city)
                 
                 print(f"城市 {city} 处理完成")
                 
@@ -322,10 +447,10 @@ def main():
             
     except KeyboardInterrupt:
         print("\n检测到用户中断，保存进度并退出...")
-        with open(global_progress_file, 'w') as f:
-            json.dump(list(processed_cities), f)
+        compact_progress_log(global_progress_file, processed_cities)
         sys.exit(0)
     
+    compact_progress_log(global_progress_file, processed_cities)
     print("\n所有城市处理完成！")
 
 if __name__ == "__main__":
@@ -2,8 +2,15 @@ import xarray as xr
 import cfgrib
 import matplotlib.pyplot as plt
 import os
+import json
 from pathlib import Path
 
+try:
+    from kerchunk.grib2 import scan_grib
+    from kerchunk.combine import MultiZarrToZarr
+except ImportError:
+    scan_grib = None
+
 def show_grib_info(ds):
     """显示grib文件的基本信息"""
     print("\n=== 数据集基本信息 ===")
@@ -35,19 +42,18 @@ def plot_rainfall_data(ds, output_dir, date_str):
         try:
             # 1. 绘制所有时间点的降水量
             plt.figure(figsize=(15, 6))
-            # 对经纬度取平均，保留时间和步长维度
-            mean_tp = ds['tp'].mean(dim=['latitude', 'longitude'])
+            # 对经纬度取平均，保留时间和步长维度（按块并行归约）
+            mean_tp = ds['tp'].mean(dim=['latitude', 'longitude']).compute()
+            if 'time' not in mean_tp.dims:
+                mean_tp = mean_tp.expand_dims('time')
             
-            # 对于每个时间点
-            for t in range(ds.dims['time']):
-                time_data = mean_tp.isel(time=t)
-                plt.plot(time_data.step, time_data.values, 
-                        label=f'Time {ds.time[t].values}')
+            # 一次调用绘制所有时间点的曲线（每列一个时间点）
+            plt.plot(mean_tp['step'], mean_tp.transpose('step', 'time').values)
+            plt.legend([f'Time {t}' for t in mean_tp['time'].values])
             
             plt.title(f'Average total rainfall change ({date_str})')
             plt.xlabel('Forecast step (h)')
             plt.ylabel('Rainfall (m)')
-            plt.legend()
             plt.grid(True)
             plt.savefig(f"{date_dir}/total_precipitation_timeseries.png")
             plt.close()
@@ -63,6 +69,51 @@ def plot_rainfall_data(ds, output_dir, date_str):
         except Exception as e:
             print(f"Error plotting charts: {str(e)}")
 
+def build_kerchunk_sidecar(grib_file):
+    """为GRIB文件生成一次Kerchunk引用JSON，之后只按需读取tp所在的字节块"""
+    sidecar = Path(str(grib_file) + '.kerchunk.json')
+    if not sidecar.exists():
+        # 每条GRIB消息一个引用集，按时间和步长合并为一个数据集
+        refs = scan_grib(str(grib_file), filter={'shortName': 'tp'})
+        combined = MultiZarrToZarr(
+            refs,
+            concat_dims=['time', 'step'],
+            identical_dims=['latitude', 'longitude']
+        ).translate()
+        with open(sidecar, 'w') as f:
+            json.dump(combined, f)
+    return sidecar
+
+def open_grib_kerchunk(grib_file):
+    """通过Kerchunk引用以zarr方式打开GRIB文件"""
+    sidecar = build_kerchunk_sidecar(grib_file)
+    return xr.open_dataset('reference://', engine='zarr', chunks={}, backend_kwargs={
+        'storage_options': {'fo': str(sidecar)},
+        'consolidated': False
+    })
+
+def open_grib(grib_file):
+    """打开GRIB文件：优先使用Kerchunk引用；否则用cfgrib，索引持久化到.idx旁路文件，失败时不加过滤重试一次"""
+    # 按单个时间点和步长分块，归约时由dask并行计算
+    chunks = {'time': 1, 'step': 1}
+    backend_kwargs = {
+        'indexpath': str(grib_file) + '.idx',
+        'cache_geo_coords': True
+    }
+    if scan_grib is not None:
+        try:
+            return open_grib_kerchunk(grib_file)
+        except Exception as e:
+            print(f"Failed to open via Kerchunk references, falling back to cfgrib: {str(e)}")
+    
+    try:
+        return xr.open_dataset(grib_file, engine='cfgrib', chunks=chunks, backend_kwargs={
+            **backend_kwargs, 'filter_by_keys': {'shortName': 'tp'}
+        })
+    except Exception as e:
+        print(f"Failed to open with shortName filter, retrying without filter: {str(e)}")
+        return xr.open_dataset(grib_file, engine='cfgrib', chunks=chunks, backend_kwargs=backend_kwargs)
+
 def analyze_era5_data():
     # 设置数据目录
     data_dir = "data/processed/era5_data"
@@ -80,34 +131,19 @@ def analyze_era5_data():
         date_str = grib_file.stem.split('_')[-1]  # 从文件名获取日期
         
         try:
-            # 尝试不同的方式读取GRIB文件
-            backends = [
-                {'filter_by_keys': {'typeOfLevel': 'surface'}},
-                {'filter_by_keys': {'edition': 1}},
-                {'filter_by_keys': {'edition': 2}},
-                {'filter_by_keys': {'shortName': 'tp'}}
-            ]
-            
-            success = False
-            for backend_kwargs in backends:
-                try:
-                    print(f"Trying with parameters: {backend_kwargs}")    
-                    ds = xr.open_dataset(grib_file, engine='cfgrib', backend_kwargs=backend_kwargs)
-                    show_grib_info(ds)
-                    plot_rainfall_data(ds, output_dir, date_str)
-                    ds.close()
-                    success = True
-                    print(f"Successfully processed file, using parameters: {backend_kwargs}")
-                    break
-                except Exception as e:
-                    print(f"Failed to use parameters {backend_kwargs}: {str(e)}")
-                    continue
-            
-            if not success:
-                print(f"All attempts failed, unable to process file: {grib_file}")
-            
+            ds = open_grib(grib_file)
+        except Exception as e:
+            print(f"Unable to open file {grib_file}: {str(e)}")
+            continue
+        
+        try:
+            show_grib_info(ds)
+            plot_rainfall_data(ds, output_dir, date_str)
+            print(f"Successfully processed file: {grib_file}")
         except Exception as e:
             print(f"Error processing file: {str(e)}")
+        finally:
+            ds.close()
 
 if __name__ == "__main__":
     analyze_era5_data() 
\ No newline at end of file
@@ -1,31 +1,73 @@
 import pandas as pd
 import geopandas as gpd
 import os
-import glob
 from pathlib import Path
-from shapely.geometry import Point
 import numpy as np
+from pyproj import CRS, Transformer
+from pyproj.aoi import AreaOfInterest
+from pyproj.database import query_utm_crs_info
+from scipy.spatial import cKDTree
 import time
-import warnings
-warnings.filterwarnings("ignore")
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def find_nearest_grid(point, grid_gdf):
-    """找到距离点最近的网格单元"""
-    # 计算点到所有网格中心的距离
-    distances = grid_gdf.geometry.distance(point)
-    # 返回距离最小的网格ID
-    return grid_gdf.iloc[distances.argmin()]['grid_id']
+# GeoParquet写入参数：GeoArrow原生几何编码（读取时无需解析WKB）、zstd压缩、bbox列支持空间过滤
+GEOPARQUET_WRITE_OPTIONS = {
+    'geometry_encoding': 'geoarrow',
+    'write_covering_bbox': True,
+    'compression': 'zstd',
+    'compression_level': 3
+}
 
-def find_containing_grid(point, grid_gdf):
-    """找到包含点的网格单元"""
-    # 找到包含该点的所有网格
-    containing = grid_gdf[grid_gdf.contains(point)]
-    if len(containing) > 0:
-        # 如果有网格包含该点，返回第一个
-        return containing.iloc[0]['grid_id']
-    else:
-        # 如果没有网格包含该点，找最近的
-        return find_nearest_grid(point, grid_gdf)
+# 网格中心点的坐标系
+GRID_CRS = "EPSG:4326"
+
+def estimate_utm_crs(lon, lat):
+    """根据网格中心点的经纬度范围估计所在的UTM坐标系"""
+    lon_center = (np.nanmin(lon) + np.nanmax(lon)) / 2
+    lat_center = (np.nanmin(lat) + np.nanmax(lat)) / 2
+    utm_info = query_utm_crs_info(
+        datum_name="WGS 84",
+        area_of_interest=AreaOfInterest(lon_center, lat_center, lon_center, lat_center)
+    )
+    return CRS.from_epsg(utm_info[0].code)
+
+def build_grid_index(lon, lat):
+    """将网格中心点保持为(N,2) float64数组，投影到UTM坐标系后构建KDTree"""
+    utm_crs = estimate_utm_crs(lon, lat)
+    transformer = Transformer.from_crs(GRID_CRS, utm_crs, always_xy=True)
+    grid_xy = np.column_stack(transformer.transform(lon, lat))
+    return cKDTree(grid_xy), utm_crs
+
+@lru_cache(maxsize=16)
+def _grid_index_from_coords(lonlat_bytes):
+    """以网格坐标本身为键缓存索引，坐标相同的网格只构建一次"""
+    lonlat = np.frombuffer(lonlat_bytes, dtype=np.float64).reshape(-1, 2)
+    return build_grid_index(lonlat[:, 0], lonlat[:, 1])
+
+@lru_cache(maxsize=16)
+def load_grid(grid_parquet_path, mtime):
+    """读取网格数据并返回(grid_id数组, KDTree, UTM坐标系)；mtime作为缓存键的一部分，文件重新生成后缓存失效"""
+    grid_df = pd.read_parquet(grid_parquet_path, columns=['grid_id', 'longitude', 'latitude'])
+    lonlat = grid_df[['longitude', 'latitude']].to_numpy(np.float64)
+    grid_tree, utm_crs = _grid_index_from_coords(lonlat.tobytes())
+    return grid_df['grid_id'].to_numpy(), grid_tree, utm_crs
+
+def find_grid_ids(gdf, grid_ids, grid_tree, utm_crs):
+    """为每个要素的中心点找到最近的网格中心点ID"""
+    # 在投影坐标系中计算中心点，距离单位为米
+    centroids = gdf.to_crs(utm_crs).geometry.centroid
+    centroid_xy = np.column_stack([centroids.x.to_numpy(), centroids.y.to_numpy()])
+    
+    # 网格只有中心点，不存在包含关系，直接查询最近的网格
+    _, nearest_idx = grid_tree.query(centroid_xy, k=1)
+    
+    return grid_ids[nearest_idx]
+
+def scan_city_files(city_folder):
+    """用一次os.scandir列出城市目录中的文件，返回{文件名: DirEntry}"""
+    with os.scandir(city_folder) as it:
+        return {entry.name: entry for entry in it if entry.is_file()}
 
 def process_road_data(city_folder, grid_data_path):
     """处理单个城市的道路数据并关联到网格，同时保存为Parquet格式"""
@@ -41,13 +83,14 @@ def process_road_data(city_folder, grid_data_path):
     roads_parquet_path = os.path.join(city_folder, "roads.parquet")
     network_parquet_path = os.path.join(city_folder, "selected_network.parquet")
     
-    # 检查文件是否存在
+    # 检查文件是否存在（城市目录只扫描一次）
+    city_files = scan_city_files(city_folder)
     files_exist = True
-    if not os.path.exists(roads_gpkg_path):
+    if "selected_roads.gpkg" not in city_files:
         print(f"Warning: roads.gpkg not found for {city_name}")
         files_exist = False
     
-    if not os.path.exists(network_geojson_path):
+    if "selected_network_4326.geojson" not in city_files:
         print(f"Warning: selected_network_4326.geojson not found for {city_name}")
         files_exist = False
     
@@ -63,70 +106,55 @@ def process_road_data(city_folder, grid_data_path):
         
         # 读取网格数据
         print(f"Loading grid data for {city_name}...")
-        grid_df = pd.read_parquet(grid_parquet_path)
-        
-        # 将网格数据转换为地理数据框
-        grid_gdf = gpd.GeoDataFrame(
-            grid_df, 
-            geometry=[Point(xy) for xy in zip(grid_df['longitude'], grid_df['latitude'])],
-            crs="EPSG:4326"  # 假设坐标是WGS84
-        )
+        grid_ids, grid_tree, utm_crs = load_grid(grid_parquet_path, os.path.getmtime(grid_parquet_path))
         
         # 处理 roads.gpkg
-        if os.path.exists(roads_gpkg_path):
+        if "selected_roads.gpkg" in city_files:
             print(f"Processing roads.gpkg for {city_name}...")
             # roads_gdf = gpd.read_file(roads_gpkg_path, layer="edges")
             roads_gdf = gpd.read_file(roads_gpkg_path)
             
             # 确保两个数据集的坐标系统一致
-            if roads_gdf.crs != grid_gdf.crs:
-                roads_gdf = roads_gdf.to_crs(grid_gdf.crs)
+            if roads_gdf.crs != GRID_CRS:
+                roads_gdf = roads_gdf.to_crs(GRID_CRS)
             
             # 方法1: 使用空间连接找到每个道路线段的中心点所在的网格
-            roads_gdf['centroid'] = roads_gdf.geometry.centroid
-            roads_gdf['grid_id'] = roads_gdf['centroid'].apply(lambda point: find_containing_grid(point, grid_gdf))
-            
-            # 删除临时的中心点列
-            roads_gdf = roads_gdf.drop(columns=['centroid'])
+            roads_gdf['grid_id'] = find_grid_ids(roads_gdf, grid_ids, grid_tree, utm_crs)
             
             # 更新原始文件（保持兼容性）
             # roads_gdf.to_file(roads_gpkg_path, driver="GPKG")
             
             # 保存为Parquet格式（节省空间）
-            roads_gdf.to_parquet(roads_parquet_path, index=False)
+            roads_gdf.to_parquet(roads_parquet_path, index=False, **GEOPARQUET_WRITE_OPTIONS)
             print(f"Saved road data with grid_id to {roads_parquet_path}")
             
             # 计算空间节省
-            gpkg_size = os.path.getsize(roads_gpkg_path) / (1024*1024)  # MB
+            gpkg_size = city_files["selected_roads.gpkg"].stat().st_size / (1024*1024)  # MB
             parquet_size = os.path.getsize(roads_parquet_path) / (1024*1024)  # MB
             space_saved = gpkg_size - parquet_size
             print(f"Space saved: {space_saved:.2f} MB ({(space_saved/gpkg_size)*100:.1f}% reduction)")
         
         # 处理 selected_network_4326.geojson
-        if os.path.exists(network_geojson_path):
+        if "selected_network_4326.geojson" in city_files:
             print(f"Processing selected_network_4326.geojson for {city_name}...")
             network_gdf = gpd.read_file(network_geojson_path)
             
             # 确保两个数据集的坐标系统一致
-            if network_gdf.crs != grid_gdf.crs:
-                network_gdf = network_gdf.to_crs(grid_gdf.crs)
+            if network_gdf.crs != GRID_CRS:
+                network_gdf = network_gdf.to_crs(GRID_CRS)
             
             # 使用空间连接找到每个网络要素的中心点所在的网格
-            network_gdf['centroid'] = network_gdf.geometry.centroid
-            network_gdf['grid_id'] = network_gdf['centroid'].apply(lambda point: find_containing_grid(point, grid_gdf))
-            
-            # 删除临时的中心点列
-            network_gdf = network_gdf.drop(columns=['centroid'])
+            network_gdf['grid_id'] = find_grid_ids(network_gdf, grid_ids, grid_tree, utm_crs)
             
             # 更新原始文件（保持兼容性）
             # network_gdf.to_file(network_geojson_path, driver="GeoJSON")
             
             # 保存为Parquet格式（节省空间）
-            network_gdf.to_parquet(network_parquet_path, index=False)
+            network_gdf.to_parquet(network_parquet_path, index=False, **GEOPARQUET_WRITE_OPTIONS)
             print(f"Saved network data with grid_id to {network_parquet_path}")
             
             # 计算空间节省
-            geojson_size = os.path.getsize(network_geojson_path) / (1024*1024)  # MB
+            geojson_size = city_files["selected_network_4326.geojson"].stat().st_size / (1024*1024)  # MB
             parquet_size = os.path.getsize(network_parquet_path) / (1024*1024)  # MB
             space_saved = geojson_size - parquet_size
             print(f"Space saved: {space_saved:.2f} MB ({(space_saved/geojson_size)*100:.1f}% reduction)")
@@ -146,7 +174,8 @@ def main():
     grid_data_path = r"data\debug\output\city_whole"
     
     # 获取所有城市文件夹
-    city_folders = [d for d in glob.glob(os.path.join(data_root, "*")) if os.path.isdir(d)]
+    with os.scandir(data_root) as it:
+        city_folders = [entry.path for entry in it if entry.is_dir()]
     
     print(f"Found {len(city_folders)} city folders")
     
@@ -156,15 +185,15 @@ def main():
     # 从进度文件加载已处理的城市(如果存在)
     processed_cities = set()
     if os.path.exists(progress_file):
-        with open(progress_file, 'r') as f:
-            processed_cities = set(line.strip() for line in f.readlines())
+        processed_cities = set(line.strip() for line in Path(progress_file).read_text().splitlines() if line.strip())
         print(f"Loaded progress: {len(processed_cities)} cities already processed")
     
     # 记录总体进度
     total_cities = len(city_folders)
     successful_count = len(processed_cities)
     
-    # 处理每个城市
+    # 收集待处理的城市
+    pending_folders = []
     for city_folder in city_folders:
         city_name = os.path.basename(city_folder)
         
@@ -173,21 +202,36 @@ def main():
             print(f"Skipping {city_name} - already processed")
             continue
         
-        # 处理城市数据
-        success = process_road_data(city_folder, grid_data_path)
+        pending_folders.append(city_folder)
+    
+    # 各城市相互独立，并行处理；进度只在主进程中更新
+    # 每个进程持有整个城市的道路数据和KD树，只用一半的核，与其他转换脚本一致
+    # 进度文件以追加模式打开一次，每个成功的城市只追加一行
+    with open(progress_file, 'a', buffering=1) as progress_log, \
+            ProcessPoolExecutor(max_workers=max(1, os.cpu_count() // 2)) as executor:
+        futures = {
+            executor.submit(process_road_data, city_folder, grid_data_path): city_folder
+            for city_folder in pending_folders
+        }
         
-        # 如果处理成功，记录进度
-        if success:
-            successful_count += 1
-            processed_cities.add(city_name)
+        for future in as_completed(futures):
+            city_name = os.path.basename(futures[future])
             
-            # 更新进度文件
-            with open(progress_file, 'w') as f:
-                for city in processed_cities:
-                    f.write(f"{city}\n")
-        
-        # 显示当前进度
-        print(f"Progress: {successful_count}/{total_cities} cities processed ({successful_count/total_cities*100:.1f}%)")
+            # 处理城市数据
+            try:
+                success = future.result()
+            except Exception as e:
+                print(f"Error processing {city_name}: {str(e)}")
+                success = False
+            
+            # 如果处理成功，记录进度
+            if success:
+                successful_count += 1
+                processed_cities.add(city_name)
+                progress_log.write(f"{city_name}\n")
+            
+            # 显示当前进度
+            print(f"Progress: {successful_count}/{total_cities} cities processed ({successful_count/total_cities*100:.1f}%)")
     
     print(f"Processing complete! {successful_count}/{total_cities} cities successfully processed.")
     
@@ -195,18 +239,15 @@ def main():
     total_original_size = 0
     total_parquet_size = 0
     for city_folder in city_folders:
-        roads_gpkg = os.path.join(city_folder, "roads.gpkg")
-        roads_parquet = os.path.join(city_folder, "roads.parquet")
-        network_geojson = os.path.join(city_folder, "selected_network_4326.geojson")
-        network_parquet = os.path.join(city_folder, "selected_network.parquet")
-        
-        if os.path.exists(roads_gpkg) and os.path.exists(roads_parquet):
-            total_original_size += os.path.getsize(roads_gpkg)
-            total_parquet_size += os.path.getsize(roads_parquet)
+        city_files = scan_city_files(city_folder)
         
-        if os.path.exists(network_geojson) and os.path.exists(network_parquet):
-            total_original_size += os.path.getsize(network_geojson)
-            total_parquet_size += os.path.getsize(network_parquet)
+        for original_name, parquet_name in [
+            ("roads.gpkg", "roads.parquet"),
+            ("selected_network_4326.geojson", "selected_network.parquet")
+        ]:
+            if original_name in city_files and parquet_name in city_files:
+                total_original_size += city_files[original_name].stat().st_size
+                total_parquet_size += city_files[parquet_name].stat().st_size
     
     # 转换为MB进行显示
     total_original_mb = total_original_size / (1024*1024)
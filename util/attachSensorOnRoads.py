@@ -1,19 +1,17 @@
 import os
 import json
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import MultiLineString, LineString
+from pyproj import Transformer
+from shapely import STRtree
+
+TO_UTM = Transformer.from_crs('epsg:4326', 'epsg:32650', always_xy=True)
 
 def load_config(config_path):
     with open(config_path, 'r') as config_file:
         return json.load(config_file)
 
-# Define a function to handle MultiLineString
-def convert_multilinestring(geometry):
-    if isinstance(geometry, MultiLineString):
-        return [LineString(line) for line in geometry.geoms]
-    return geometry
-
 if __name__ == "__main__":
     # config = load_config(r'config.json')
     # cities = config['cities']
@@ -31,35 +29,32 @@ if __name__ == "__main__":
 
         ori_road = gpd.read_file(road_file, driver='GeoJSON')
         ori_road.set_crs('epsg:32650', inplace=True, allow_override=True)  # Explicitly set CRS
-        ori_road['geometry'] = ori_road['geometry'].apply(convert_multilinestring)
-
-        # Correctly handle exploded GeoDataFrame
-        if isinstance(ori_road.explode(), gpd.GeoDataFrame):
-            ex_ori_road = ori_road.explode().reset_index(drop=True)
-        else:
-            ex_ori_road = gpd.GeoDataFrame(ori_road.explode(), geometry='geometry')
 
-        ex_ori_road['road_length'] = ex_ori_road.length.round(2)  # Calculate the length of each road
-        ex_ori_road.set_crs('epsg:32650', inplace=True)
-        # roads_gdf = ex_ori_road.to_crs(epsg=4326)  # Convert to EPSG:4326
-        roads_gdf = ex_ori_road.copy()
-        roads_gdf.reset_index(drop=True, inplace=True)
-        roads_gdf['road_id'] = roads_gdf.index
+        # Split MultiLineStrings into single LineStrings in one pass
+        roads_gdf = ori_road.explode(index_parts=False, ignore_index=True)
+        roads_gdf['road_length'] = roads_gdf.length.round(2)  # Calculate the length of each road
+        # roads_gdf = roads_gdf.to_crs(epsg=4326)  # Convert to EPSG:4326
+        roads_gdf['road_id'] = np.arange(len(roads_gdf))
 
         ex_detectors = pd.read_csv(detector_file)
-        ex_detectors['geometry'] = gpd.points_from_xy(ex_detectors['long'], ex_detectors['lat'])
-        ex_detectors_gdf = gpd.GeoDataFrame(ex_detectors, geometry='geometry')
-        ex_detectors_gdf.set_crs('epsg:4326', inplace=True)
-        detectors_gdf = ex_detectors_gdf.to_crs('epsg:32650')
+        # Project detector coordinates straight to EPSG:32650 in one vectorized call
+        xs, ys = TO_UTM.transform(ex_detectors['long'].to_numpy(), ex_detectors['lat'].to_numpy())
+        detectors_gdf = gpd.GeoDataFrame(ex_detectors, geometry=gpd.points_from_xy(xs, ys), crs='epsg:32650')
         # Initialize detid column
         roads_gdf['detid'] = -1
 
-        # Find the nearest road for each detector
-        for index, detector in detectors_gdf.iterrows():
-            # print(roads_gdf.distance(detector.geometry))
-            # print(f"Processing detector: {detector['detid']}")
-            nearest_road = roads_gdf.distance(detector.geometry).idxmin()
-            roads_gdf.at[nearest_road, 'detid'] = detector['detid']
+        # Find the nearest road for each detector with one bulk STRtree query
+        tree = STRtree(roads_gdf.geometry.values)
+        det_idx, road_idx = tree.query_nearest(detectors_gdf.geometry.values, all_matches=True)
+        # On distance ties keep the lowest road index (same as idxmin)
+        order = np.lexsort((road_idx, det_idx))
+        det_idx, road_idx = det_idx[order], road_idx[order]
+        first = np.r_[True, det_idx[1:] != det_idx[:-1]]
+        det_idx, road_idx = det_idx[first], road_idx[first]
+        # If several detectors share a road, the last detector wins as before
+        _, last = np.unique(road_idx[::-1], return_index=True)
+        keep = len(road_idx) - 1 - last
+        roads_gdf.iloc[road_idx[keep], roads_gdf.columns.get_loc('detid')] = detectors_gdf['detid'].to_numpy()[det_idx[keep]]
 
         # Save the updated GeoJSON file
         final_road_gdf = roads_gdf.to_crs('epsg:4326')
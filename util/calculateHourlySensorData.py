@@ -1,9 +1,150 @@
 import pandas as pd
 import numpy as np
 import os
-import glob
 from pathlib import Path
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if njit is not None:
+    # 内核保持串行：并行发生在城市级别的进程池，避免每个进程再启动一组numba线程
+    @njit
+    def _aggregate_groups(starts, ends, flow, speed, occ, error):
+        """按预排序的分组边界计算每组的求和、均值和流量加权速度（跳过NaN）"""
+        n_groups = len(starts)
+        flow_sum = np.zeros(n_groups)
+        occ_mean = np.full(n_groups, np.nan)
+        speed_mean = np.full(n_groups, np.nan)
+        flow_x_speed = np.zeros(n_groups)
+        flow_valid = np.zeros(n_groups)
+        flow_missing = np.zeros(n_groups, dtype=np.bool_)
+        error_mean = np.full(n_groups, np.nan)
+        
+        for g in range(n_groups):
+            occ_total = 0.0
+            occ_n = 0
+            speed_total = 0.0
+            speed_n = 0
+            error_total = 0.0
+            error_n = 0
+            for i in range(starts[g], ends[g]):
+                if not np.isnan(flow[i]):
+                    flow_sum[g] += flow[i]
+                if not np.isnan(occ[i]):
+                    occ_total += occ[i]
+                    occ_n += 1
+                if not np.isnan(speed[i]):
+                    speed_total += speed[i]
+                    speed_n += 1
+                    if np.isnan(flow[i]):
+                        flow_missing[g] = True
+                    else:
+                        flow_x_speed[g] += flow[i] * speed[i]
+                        flow_valid[g] += flow[i]
+                if not np.isnan(error[i]):
+                    error_total += error[i]
+                    error_n += 1
+            if occ_n > 0:
+                occ_mean[g] = occ_total / occ_n
+            if speed_n > 0:
+                speed_mean[g] = speed_total / speed_n
+            if error_n > 0:
+                error_mean[g] = error_total / error_n
+        
+        return flow_sum, occ_mean, speed_mean, flow_x_speed, flow_valid, flow_missing, error_mean
+
+def _aggregate_hourly_numba(sensor_df, has_speed_column, has_error_column):
+    """排序一次后由numba内核按组聚合，返回与groupby-agg相同结构的结果"""
+    # 分组键编码为整数（与groupby一样丢弃键为NaN的行），并按键排序
+    hour_codes, hour_uniques = pd.factorize(sensor_df['hour'], sort=True)
+    detid_codes, detid_uniques = pd.factorize(sensor_df['detid'], sort=True)
+    city_codes, city_uniques = pd.factorize(sensor_df['city'], sort=True)
+    valid = (hour_codes >= 0) & (detid_codes >= 0) & (city_codes >= 0)
+    rows = np.flatnonzero(valid)
+    rows = rows[np.lexsort((city_codes[rows], detid_codes[rows], hour_codes[rows]))]
+    
+    hour_codes, detid_codes, city_codes = hour_codes[rows], detid_codes[rows], city_codes[rows]
+    changed = np.ones(len(rows), dtype=bool)
+    changed[1:] = (
+        (hour_codes[1:] != hour_codes[:-1]) |
+        (detid_codes[1:] != detid_codes[:-1]) |
+        (city_codes[1:] != city_codes[:-1])
+    )
+    starts = np.flatnonzero(changed)
+    ends = np.append(starts[1:], len(rows)) if len(starts) else starts
+    
+    def column(name, present=True):
+        if not present:
+            return np.full(len(rows), np.nan)
+        return sensor_df[name].to_numpy(dtype=np.float64)[rows]
+    
+    (flow_sum, occ_mean, speed_mean, flow_x_speed,
+     flow_valid, flow_missing, error_mean) = _aggregate_groups(
+        starts, ends,
+        column('flow'), column('speed', has_speed_column),
+        column('occ'), column('error', has_error_column)
+    )
+    
+    index = pd.MultiIndex.from_arrays([
+        hour_uniques[hour_codes[starts]],
+        detid_uniques[detid_codes[starts]],
+        city_uniques[city_codes[starts]]
+    ], names=['hour', 'detid', 'city'])
+    agg = pd.DataFrame({
+        'flow_sum': flow_sum,
+        'samples_count': ends - starts,
+        'occ_mean': occ_mean
+    }, index=index)
+    
+    if has_speed_column:
+        agg['speed_mean'] = speed_mean
+        agg['flow_x_speed'] = flow_x_speed
+        agg['flow_valid'] = flow_valid
+        agg['flow_missing'] = flow_missing
+    
+    if has_error_column:
+        agg['error_mean'] = error_mean
+    
+    return agg
+
+def _aggregate_hourly_groupby(sensor_df, has_speed_column, has_error_column):
+    """使用pandas groupby-agg一次性聚合"""
+    # 准备聚合所需的列
+    agg_input = sensor_df[['hour', 'detid', 'city', 'flow', 'occ']].copy()
+    aggregations = {
+        'flow_sum': ('flow', 'sum'),
+        'samples_count': ('flow', 'size'),
+        'occ_mean': ('occ', 'mean')
+    }
+    
+    if has_speed_column:
+        # 流量加权平均速度只使用速度非NaN的行：sum(flow*speed) / sum(flow)
+        valid_speed = sensor_df['speed'].notna()
+        agg_input['speed'] = sensor_df['speed']
+        agg_input['flow_x_speed'] = sensor_df['flow'] * sensor_df['speed']
+        agg_input['flow_valid'] = sensor_df['flow'].where(valid_speed)
+        # 有效速度行中流量缺失时，加权平均为NaN（与np.average一致）
+        agg_input['flow_missing'] = valid_speed & sensor_df['flow'].isna()
+        aggregations.update({
+            'speed_mean': ('speed', 'mean'),
+            'flow_x_speed': ('flow_x_speed', 'sum'),
+            'flow_valid': ('flow_valid', 'sum'),
+            'flow_missing': ('flow_missing', 'any')
+        })
+    
+    if has_error_column:
+        agg_input['error'] = sensor_df['error']
+        aggregations['error_mean'] = ('error', 'mean')
+    
+    # 按小时、传感器ID和城市分组，一次性聚合
+    return agg_input.groupby(['hour', 'detid', 'city']).agg(**aggregations)
 
 def calculate_hourly_data(sensor_df):
     """
@@ -13,7 +154,7 @@ def calculate_hourly_data(sensor_df):
     - sensor_df: 包含传感器数据的DataFrame
     
     Returns:
-    - hourly_df: 聚合后的小时级数据
+    - hourly_table: 聚合后的小时级数据（pyarrow.Table）
     """
     # 确保时间列的格式正确
     sensor_df['day'] = pd.to_datetime(sensor_df['day'])
@@ -22,69 +163,65 @@ def calculate_hourly_data(sensor_df):
     sensor_df['datetime'] = sensor_df['day'] + pd.to_timedelta(sensor_df['interval'], unit='s')
     # 创建小时时间戳
     sensor_df['hour'] = sensor_df['datetime'].dt.floor('h')
-    # 按小时、传感器ID和城市分组
-    grouped = sensor_df.groupby(['hour', 'detid', 'city'])
+    has_speed_column = 'speed' in sensor_df.columns
+    has_error_column = 'error' in sensor_df.columns
     
-    # 初始化结果列表
-    hourly_data = []
+    # 有numba时使用编译内核，否则退回pandas groupby
+    if njit is not None:
+        agg = _aggregate_hourly_numba(sensor_df, has_speed_column, has_error_column)
+    else:
+        agg = _aggregate_hourly_groupby(sensor_df, has_speed_column, has_error_column)
     
-    for (hour, detid, city), group in grouped:
-        # 计算样本数量
-        samples_count = len(group)
-        
-        # 1. 流量：求和和平均
-        flow_sum = group['flow'].sum()
-        flow_mean_5min = flow_sum / samples_count if samples_count > 0 else 0
-        
-        # 2. 速度：检查列是否存在和是否有非NaN值
-        has_speed_column = 'speed' in group.columns
-        has_valid_speed = has_speed_column and not group['speed'].isna().all()
-        
-        # 设置默认值
-        speed_mean = np.nan
-        speed_weight = np.nan
-        
-        # 如果有有效的速度数据，则计算平均值
-        if has_valid_speed:
-            speed_mean = group['speed'].mean()
-            
-            # 过滤掉速度为NaN的行
-            valid_data = group.dropna(subset=['speed'])
-            
-            # 计算流量加权平均速度
-            if not valid_data.empty and valid_data['flow'].sum() > 0:
-                speed_weight = np.average(
-                    valid_data['speed'], 
-                    weights=valid_data['flow'],
-                    axis=0
-                )
-        
-        # 3. 占有率：算术平均
-        occ_mean = group['occ'].mean()
-        
-        # 4. 统计错误率
-        error_mean = group['error'].mean() if 'error' in group.columns else np.nan
-        
-        # 5. 格式化日期时间为指定格式 (DD/MM/YYYY HH:MM:SS)
-        formatted_datetime = hour.strftime('%d/%m/%Y %H:%M:%S')
-        
-        # 添加到结果列表
-        hourly_data.append({
-            'datetime': formatted_datetime,
-            'detid': detid,
-            'flow_sum': flow_sum,
-            'flow_mean_5min': flow_mean_5min,
-            'occ_mean': occ_mean,
-            'speed_mean': speed_mean,
-            'speed_weight': speed_weight,
-            'error_mean': error_mean,
-            'city': city
-        })
+    # 1. 流量：求和和平均
+    flow_mean_5min = agg['flow_sum'] / agg['samples_count']
+    
+    # 2. 速度：算术平均和流量加权平均
+    if has_speed_column:
+        speed_mean = agg['speed_mean'].to_numpy()
+        speed_weight = (agg['flow_x_speed'] / agg['flow_valid']).where(
+            (agg['flow_valid'] > 0) & ~agg['flow_missing']
+        ).to_numpy()
+    else:
+        speed_mean = np.full(len(agg), np.nan)
+        speed_weight = np.full(len(agg), np.nan)
     
-    # 转换为DataFrame
-    hourly_df = pd.DataFrame(hourly_data)
+    # 3. 统计错误率
+    error_mean = agg['error_mean'].to_numpy() if has_error_column else np.full(len(agg), np.nan)
     
-    return hourly_df
+    # 4. 格式化日期时间为指定格式 (DD/MM/YYYY HH:MM:SS)
+    formatted_datetime = agg.index.get_level_values('hour').strftime('%d/%m/%Y %H:%M:%S')
+    
+    # 直接由分组结果构建Arrow表，避免再物化一个pandas DataFrame
+    hourly_table = pa.table({
+        'datetime': pa.array(formatted_datetime.to_numpy(dtype=object), type=pa.string()),
+        'detid': pa.array(agg.index.get_level_values('detid').to_numpy()),
+        'flow_sum': agg['flow_sum'].to_numpy(),
+        'flow_mean_5min': flow_mean_5min.to_numpy(),
+        'occ_mean': agg['occ_mean'].to_numpy(),
+        'speed_mean': speed_mean,
+        'speed_weight': speed_weight,
+        'error_mean': error_mean,
+        'city': pa.array(agg.index.get_level_values('city').to_numpy())
+    })
+    
+    return hourly_table
+
+def read_sensor_csv(sensor_file):
+    """以流式RecordBatch多线程读取传感器CSV，最后一次性转换为pandas"""
+    reader = pacsv.open_csv(
+        sensor_file,
+        read_options=pacsv.ReadOptions(block_size=64 << 20, use_threads=True),
+        convert_options=pacsv.ConvertOptions(column_types={
+            'interval': pa.int32(),
+            'flow': pa.float64(),
+            'speed': pa.float64(),
+            'occ': pa.float64(),
+            'error': pa.float64()
+        })
+    )
+    table = reader.read_all()
+    # 转换时逐列释放Arrow内存，避免两份数据同时驻留
+    return table.to_pandas(split_blocks=True, self_destruct=True)
 
 def process_city_sensor_data(city_folder):
     """处理某个城市的传感器数据并保存小时级聚合结果"""
@@ -93,12 +230,16 @@ def process_city_sensor_data(city_folder):
     sensor_file = os.path.join(city_folder, f"{city_name}.csv")
     output_file = os.path.join(city_folder, "hourly_readings.parquet")
     
+    # 城市目录只扫描一次，之后用集合判断文件是否存在
+    with os.scandir(city_folder) as it:
+        city_files = {entry.name for entry in it}
+    
     # 检查该城市的结果文件是否已存在（断点续传）
-    if os.path.exists(output_file):
+    if "hourly_readings.parquet" in city_files:
         print(f"Skipping {city_name} - already processed")
         return True
     
-    if not os.path.exists(sensor_file):
+    if f"{city_name}.csv" not in city_files:
         print(f"No sensor data found for {city_name}")
         return False
     
@@ -107,13 +248,18 @@ def process_city_sensor_data(city_folder):
         print(f"Processing {city_name} sensor data...")
         
         # 读取传感器数据
-        sensor_df = pd.read_csv(sensor_file)
+        sensor_df = read_sensor_csv(sensor_file)
         
         # 计算小时级数据
-        hourly_df = calculate_hourly_data(sensor_df)
+        hourly_table = calculate_hourly_data(sensor_df)
         
-        # 保存结果到城市文件夹
-        hourly_df.to_parquet(output_file, index=False)
+        # 保存结果到城市文件夹（ZSTD压缩，detid和city使用字典编码）
+        pq.write_table(
+            hourly_table, output_file,
+            compression='zstd', compression_level=3,
+            use_dictionary=['detid', 'city'],
+            row_group_size=200_000
+        )
         
         elapsed_time = time.time() - start_time
         print(f"Processed {city_name} in {elapsed_time:.2f} seconds - Saved to {output_file}")
@@ -128,7 +274,8 @@ def main():
     data_root = r"data\debug\input"
     
     # 获取所有城市文件夹
-    city_folders = [d for d in glob.glob(os.path.join(data_root, "*")) if os.path.isdir(d)]
+    with os.scandir(data_root) as it:
+        city_folders = [entry.path for entry in it if entry.is_dir()]
     
     # 创建进度文件路径
     progress_file = os.path.join(data_root, "hourly_processing_progress.txt")
@@ -136,8 +283,7 @@ def main():
     # 从进度文件加载已处理的城市（如果存在）
     processed_cities = set()
     if os.path.exists(progress_file):
-        with open(progress_file, 'r') as f:
-            processed_cities = set(line.strip() for line in f.readlines())
+        processed_cities = set(line.strip() for line in Path(progress_file).read_text().splitlines() if line.strip())
         print(f"Loaded progress: {len(processed_cities)} cities already processed")
     
     # 记录总体进度
@@ -146,7 +292,8 @@ def main():
     
     print(f"Found {total_cities} cities, {total_cities - successful_count} remaining to process")
     
-    # 处理每个城市，跳过已处理的
+    # 收集待处理的城市，跳过已处理的
+    pending_folders = []
     for city_folder in city_folders:
         city_name = os.path.basename(city_folder)
         
@@ -155,21 +302,36 @@ def main():
             print(f"Skipping {city_name} - already in progress file")
             continue
         
-        # 处理城市数据
-        success = process_city_sensor_data(city_folder)
+        pending_folders.append(city_folder)
+    
+    # 各城市相互独立，并行处理；进度只在主进程中更新
+    # 只用一半的核，与其他转换脚本一致
+    # 进度文件以追加模式打开一次，每个成功的城市只追加一行
+    with open(progress_file, 'a', buffering=1) as progress_log, \
+            ProcessPoolExecutor(max_workers=max(1, os.cpu_count() // 2)) as executor:
+        futures = {
+            executor.submit(process_city_sensor_data, city_folder): city_folder
+            for city_folder in pending_folders
+        }
         
-        # 如果处理成功，记录进度
-        if success:
-            successful_count += 1
-            processed_cities.add(city_name)
+        for future in as_completed(futures):
+            city_name = os.path.basename(futures[future])
             
-            # 更新进度文件
-            with open(progress_file, 'w') as f:
-                for city in processed_cities:
-                    f.write(f"{city}\n")
-        
-        # 显示当前进度
-        print(f"Progress: {successful_count}/{total_cities} cities processed ({successful_count/total_cities*100:.1f}%)")
+            # 处理城市数据
+            try:
+                success = future.result()
+            except Exception as e:
+                print(f"Error processing {city_name}: {str(e)}")
+                success = False
+            
+            # 如果处理成功，记录进度
+            if success:
+                successful_count += 1
+                processed_cities.add(city_name)
+                progress_log.write(f"{city_name}\n")
+            
+            # 显示当前进度
+            print(f"Progress: {successful_count}/{total_cities} cities processed ({successful_count/total_cities*100:.1f}%)")
     
     print(f"Processing complete! {successful_count}/{total_cities} cities successfully processed.")
     
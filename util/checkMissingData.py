@@ -1,4 +1,6 @@
+import os
 import pandas as pd
+import pyarrow.dataset as ds
 import numpy as np
 from pathlib import Path
 import json
@@ -41,16 +43,25 @@ class DataCompleteness:
             print(f"Cannot find processed data directory: {processed_path}")
             return
         
+        # 一次性列出ERA5目录，后续用集合判断GRIB文件是否存在
+        era5_files = set(os.listdir(era5_root)) if Path(era5_root).exists() else set()
+        
         # 获取所有已处理的日期
-        processed_files = list(processed_path.glob('hourly_rainfall_*.parquet'))
-        processed_dates = [pd.to_datetime(f.stem.split('_')[-1]).date() for f in processed_files]
+        processed_files = sorted(processed_path.glob('hourly_rainfall_*.parquet'))
+        if not processed_files:
+            print(f"No processed rainfall files found in {processed_path}")
+            return
+        
+        # 所有日期文件只发现一次并统一schema，之后每个文件只读取datetime列
+        dataset = ds.dataset([str(f) for f in processed_files], format='parquet')
         
         # 分析每个日期
-        for date in processed_dates:
+        for fragment in dataset.get_fragments():
+            date = pd.to_datetime(Path(fragment.path).stem.split('_')[-1]).date()
             print(f"\nChecking date: {date}")
             
-            # 读取当前日期的数据
-            df = pd.read_parquet(processed_path / f'hourly_rainfall_{date}.parquet')
+            # 读取当前日期的数据（仅datetime列）
+            df = fragment.to_table(columns=['datetime']).to_pandas()
             
             # 使用TimeConverter进行时间转换和检查
             utc_start = pd.Timestamp(f"{date} 00:00")
@@ -79,16 +90,20 @@ class DataCompleteness:
             missing_hours = set(local_hours) - set(actual_hours)
             if missing_hours:
                 print("\nMissing hours:")
-                for missing_hour in sorted(missing_hours):
-                    # 转换回UTC时间来确定需要的GRIB文件
-                    utc_result = self.time_converter.local_to_utc(missing_hour, city_timezone)
-                    print(f"Local time: {missing_hour}, UTC time: {utc_result['utc_time']}")
-                    
-                    # 检查是否需要额外的GRIB文件
-                    grib_date = utc_result['utc_time'].date()
-                    grib_file = Path(era5_root) / f"era5_rainfall_{grib_date}.grib"
-                    if not grib_file.exists():
-                        print(f"Required GRIB file: era5_rainfall_{grib_date}.grib")
+                missing_hours = pd.DatetimeIndex(sorted(missing_hours))
+                
+                # 一次性转换回UTC时间来确定需要的GRIB文件（不存在或重复的本地时间记为NaT）
+                utc_times = missing_hours.tz_localize(
+                    city_timezone, nonexistent='NaT', ambiguous='NaT'
+                ).tz_convert('UTC').tz_localize(None)
+                for missing_hour, utc_time in zip(missing_hours, utc_times):
+                    print(f"Local time: {missing_hour}, UTC time: {utc_time}")
+                
+                # 检查是否需要额外的GRIB文件
+                for grib_date in pd.Index(utc_times.dropna().date).unique():
+                    grib_name = f"era5_rainfall_{grib_date}.grib"
+                    if grib_name not in era5_files:
+                        print(f"Required GRIB file: {grib_name}")
             
             # 分析数据分布
             print(f"Data time range: {min(actual_hours)} to {max(actual_hours)}")
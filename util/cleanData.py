@@ -18,7 +18,9 @@ def clean_era5_city_folders(base_dir="data/processed/era5_city", dry_run=True):
         return
     
     # 获取所有城市文件夹
-    city_folders = [f for f in base_path.iterdir() if f.is_dir()]
+    # os.scandir直接从目录项获得文件类型，无需对每个子项再调用stat
+    with os.scandir(base_path) as it:
+        city_folders = [Path(e.path) for e in it if e.is_dir(follow_symlinks=False)]
     
     if not city_folders:
         print(f"没有找到城市文件夹在 {base_dir}")
@@ -47,44 +49,38 @@ def clean_era5_city_folders(base_dir="data/processed/era5_city", dry_run=True):
         else:
             print(f"  警告: {grid_info_path} 不存在")
         
-        # 遍历城市文件夹中的所有文件和目录
-        for root, dirs, files in os.walk(city_folder, topdown=False):  # topdown=False 确保先处理子目录
-            root_path = Path(root)
-            
-            # 处理文件
-            for file in files:
-                file_path = root_path / file
-                
-                # 如果不是要保留的文件，则删除
-                if file_path != grid_info_path:
-                    if dry_run:
-                        print(f"  将删除文件: {file_path}")
+        # 只列出一次城市目录的直接子项：weather目录中只保留grid_info.parquet，其余子项整体删除
+        to_delete = []
+        with os.scandir(city_folder) as it:
+            for entry in it:
+                if entry.name == "weather" and entry.is_dir(follow_symlinks=False):
+                    with os.scandir(entry.path) as weather_it:
+                        to_delete.extend(e for e in weather_it if e.path != str(grid_info_path))
+                else:
+                    to_delete.append(entry)
+        
+        city_files = sum(1 for e in to_delete if not e.is_dir(follow_symlinks=False))
+        city_folders_count = len(to_delete) - city_files
+        
+        if dry_run:
+            print(f"  将删除 {city_files} 个文件和 {city_folders_count} 个目录（含其全部内容）")
+        else:
+            for entry in to_delete:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
                     else:
-                        try:
-                            file_path.unlink()
-                            print(f"  已删除文件: {file_path}")
-                            deleted_files += 1
-                        except Exception as e:
-                            print(f"  删除文件时出错 {file_path}: {str(e)}")
-            
-            # 处理目录
-            # 不删除weather目录和城市目录本身
-            if (root_path != city_folder and 
-                root_path != city_folder / "weather" and
-                (not grid_info_exists or "weather" not in root_path.parts)):
-                
-                # 检查目录是否为空
-                if not any(root_path.iterdir()) or not grid_info_exists:
-                    if dry_run:
-                        print(f"  将删除目录: {root_path}")
+                        os.unlink(entry.path)
+                except Exception as e:
+                    print(f"  删除时出错 {entry.path}: {str(e)}")
+                    if entry.is_dir(follow_symlinks=False):
+                        city_folders_count -= 1
                     else:
-                        try:
-                            # 使用rmdir只能删除空目录
-                            root_path.rmdir()
-                            print(f"  已删除目录: {root_path}")
-                            deleted_folders += 1
-                        except Exception as e:
-                            print(f"  删除目录时出错 {root_path}: {str(e)}")
+                        city_files -= 1
+            print(f"  已删除 {city_files} 个文件和 {city_folders_count} 个目录（含其全部内容）")
+        
+        deleted_files += city_files
+        deleted_folders += city_folders_count
         
         # 确保weather目录存在
         weather_dir = city_folder / "weather"
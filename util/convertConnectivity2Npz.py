@@ -1,10 +1,71 @@
 import os
 import glob
+import json
+from pathlib import Path
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely import wkb
+import pyarrow.parquet as pq
+import shapely
 import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# 指标矩阵的16位编码：存储值 = round(原值 * scale)，NaN记为哨兵值
+# 下表为最高精度：流量（veh/h，不一定是整数）、速度保留两位小数；占有率为0-1的比例，保留四位小数
+# 编码时按矩阵的实际最大值逐级除以10降低scale（最低到1）使其放入int16，实际scale写入metric_encoding
+METRIC_SCALES = {
+    'flow': 100, 'flow_sum': 100, 'flow_mean_5min': 100,
+    'speed': 100, 'speed_mean': 100, 'speed_weight': 100,
+    'occ': 10000, 'occ_mean': 10000
+}
+
+# 逐批读取传感器数据的行数，限制峰值内存
+READINGS_BATCH_SIZE = 500_000
+
+def encode_metric(array, scale):
+    """
+    将float32指标矩阵编码为int16，返回(编码数组, 哨兵值, 实际使用的scale)
+    
+    scale为最高精度，按矩阵中有限值的最大绝对值逐级除以10直到能放入int16（最低为1）；
+    scale为1仍超出范围时才退回int32
+    """
+    values = array.astype(np.float64)
+    finite = values[np.isfinite(values)]
+    max_abs = np.abs(finite).max() if finite.size else 0.0
+    int16_limit = np.iinfo(np.int16).max - 1  # 最小值留作哨兵
+    while scale > 1 and np.round(max_abs * scale) > int16_limit:
+        scale //= 10
+    dtype = np.int16 if np.round(max_abs * scale) <= int16_limit else np.int32
+    scaled = np.round(values * scale)
+    nan_value = np.iinfo(dtype).min
+    encoded = np.where(np.isnan(scaled), nan_value, scaled).astype(dtype)
+    return encoded, int(nan_value), int(scale)
+
+def geoparquet_geometry_columns(schema):
+    """返回GeoParquet中的几何列及其覆盖（bbox）列的列名集合，按文件的geo元数据确定"""
+    columns = {'geometry', 'bbox'}
+    geo = (schema.metadata or {}).get(b'geo')
+    if geo is None:
+        return columns
+    for name, column_meta in json.loads(geo).get('columns', {}).items():
+        columns.add(name)
+        # covering: {"bbox": {"xmin": ["bbox", "xmin"], ...}}，路径的第一项为列名
+        for paths in column_meta.get('covering', {}).values():
+            columns.update(path[0] for path in paths.values())
+    return columns
+
+def save_npz(output_npz, arrays, compresslevel=1):
+    """
+    逐个数组流式写入npz文件，与np.load兼容
+    
+    使用低压缩级别的zip deflate，写入速度比np.savez_compressed的默认级别快数倍，文件略大
+    """
+    with zipfile.ZipFile(output_npz, mode='w', compression=zipfile.ZIP_DEFLATED,
+                         compresslevel=compresslevel, allowZip64=True) as zf:
+        for name, value in arrays.items():
+            with zf.open(f"{name}.npy", mode='w', force_zip64=True) as f:
+                np.lib.format.write_array(f, np.asanyarray(value), allow_pickle=True)
 
 def convert_to_optimized_npz(city_folder):
     """
@@ -42,15 +103,18 @@ def convert_to_optimized_npz(city_folder):
         start_time = time.time()
         
         # 1. 读取道路网络数据
-        print("Reading road network data...")
-        if "wkb" in pd.read_parquet(network_parquet, columns=None).columns:
+        # 只读取需要的列：geometry列及其bbox覆盖列不会被保存，跳过读取
+        network_schema = pq.read_schema(network_parquet)
+        skipped_columns = geoparquet_geometry_columns(network_schema)
+        network_columns = [c for c in network_schema.names if c not in skipped_columns]
+        network_df = pq.read_table(network_parquet, columns=network_columns).to_pandas(self_destruct=True)
+        if "wkb" in network_df.columns:
             # 如果包含WKB列，需要转换回几何对象
-            df = pd.read_parquet(network_parquet)
-            geometry = df['wkb'].apply(lambda x: wkb.loads(x) if x else None)
-            network_df = gpd.GeoDataFrame(df.drop(columns=['wkb']), geometry=geometry)
-        else:
-            # 直接读取
-            network_df = pd.read_parquet(network_parquet)
+            wkb_values = network_df['wkb'].to_numpy(dtype=object)
+            # 空值（None/NaN/空字节）统一视为缺失几何
+            wkb_values[pd.isna(wkb_values) | (wkb_values == b'')] = None
+            geometry = shapely.from_wkb(wkb_values)
+            network_df = gpd.GeoDataFrame(network_df.drop(columns=['wkb']), geometry=geometry)
         
         # 确保有road_id列，如果没有则尝试使用其他可能的ID列
         id_columns = ['road_id', 'id', 'edge_id', 'index']
@@ -66,39 +130,35 @@ def convert_to_optimized_npz(city_folder):
             road_id_col = 'road_id'
         
         # 2. 按road_id排序完整网络
-        print(f"Sorting complete network by {road_id_col}...")
         network_df = network_df.sort_values(by=road_id_col).reset_index(drop=True)
         
         # 3. 识别有传感器的道路
-        print("Identifying roads with sensors...")
         has_sensor_mask = network_df['detid'] != '-1'
         
         sensor_roads = network_df[has_sensor_mask].copy().reset_index(drop=True)
-        print(f"Complete network: {len(network_df)} roads")
-        print(f"Roads with sensors: {len(sensor_roads)}")
         
         # 4. 创建映射：完整网络索引 -> 传感器道路索引
-        network_to_sensor = {}
-        sensor_to_network = {}
-        
-        for i, (idx, road) in enumerate(sensor_roads.iterrows()):
-            original_idx = network_df[network_df[road_id_col] == road[road_id_col]].index[0]
-            network_to_sensor[original_idx] = i
-            sensor_to_network[i] = original_idx
+        # 用整数数组表示映射：sensor_to_network[i]为传感器道路i在完整网络中的索引，
+        # network_to_sensor[j]为网络道路j对应的传感器索引（没有传感器为-1）
+        # sensor_roads正是完整网络中掩码为真的行，掩码位置即所需索引
+        sensor_to_network = np.flatnonzero(has_sensor_mask.to_numpy())
+        network_to_sensor = np.full(len(network_df), -1, dtype=np.int64)
+        network_to_sensor[sensor_to_network] = np.arange(len(sensor_roads))
         
         # 5. 读取传感器数据
-        print("Reading sensor data...")
-        readings_df = pd.read_parquet(readings_parquet)
+        readings_file = pq.ParquetFile(readings_parquet)
+        readings_columns = readings_file.schema_arrow.names
         
-        # 6. 创建传感器ID到传感器道路索引的映射
-        detid_to_sensor_idx = {}
-        for i, (_, road) in enumerate(sensor_roads.iterrows()):
-            detid_to_sensor_idx[road['detid']] = i
+        # 6. 创建传感器ID到传感器道路索引的映射（重复的detid对应最后一条传感器道路）
+        sensor_detids = pd.Index(sensor_roads['detid'])
+        last_detid = ~sensor_detids.duplicated(keep='last')
+        detid_categories = sensor_detids[last_detid]
+        detid_sensor_idx = np.flatnonzero(last_detid)
         
-        # 7. 提取unique的时间戳
+        # 7. 确定时间列和指标列，只读取这些列
         time_column = None
         for col in ['datetime', 'timestamp', 'time', 'date']:
-            if col in readings_df.columns:
+            if col in readings_columns:
                 time_column = col
                 break
         
@@ -106,66 +166,59 @@ def convert_to_optimized_npz(city_folder):
             print("Error: No time column found in readings data")
             return False
         
-        timestamps = sorted(readings_df[time_column].unique())
-        print(f"Found {len(timestamps)} unique timestamps")
-        
-        # 8. 创建传感器数据矩阵 (时间戳 x 传感器道路)
         # 假设有这些指标: flow, speed, occupancy
         data_columns = {}
         for col in ['flow', 'flow_sum', 'flow_mean_5min', 'speed', 'speed_mean', 'speed_weight', 'occ', 'occ_mean']:
-            if col in readings_df.columns:
-                data_columns[col] = readings_df.columns.get_loc(col)
+            if col in readings_columns:
+                data_columns[col] = readings_columns.index(col)
         
         if not data_columns:
             print("Error: No valid data columns found in readings data")
             return False
         
-        # 准备数组和时间索引映射
-        time_to_idx = {t: i for i, t in enumerate(timestamps)}
+        # 第一遍只读时间列，逐批累积唯一时间戳（缺失时间不作为类别）
+        batch_times = [
+            pd.unique(batch.column(0).to_pandas().dropna().to_numpy())
+            for batch in readings_file.iter_batches(batch_size=READINGS_BATCH_SIZE, columns=[time_column])
+        ]
+        timestamps = np.sort(pd.unique(np.concatenate(batch_times))) if batch_times else np.array([], dtype='datetime64[ns]')
+        
+        # 8. 创建传感器数据矩阵 (时间戳 x 传感器道路)
         n_times = len(timestamps)
         n_sensor_roads = len(sensor_roads)
         
-        # 为每个指标创建数组 - 只为有传感器的道路创建
         data_arrays = {}
         for col_name in data_columns:
             data_arrays[col_name] = np.full((n_times, n_sensor_roads), np.nan, dtype=np.float32)
         
-        # 填充数据矩阵
-        print("Building data matrices...")
-        for _, row in readings_df.iterrows():
-            if row['detid'] in detid_to_sensor_idx:
-                t_idx = time_to_idx.get(row[time_column])
-                r_idx = detid_to_sensor_idx[row['detid']]
-                
-                if t_idx is not None:
-                    for col_name, col_idx in data_columns.items():
-                        if not pd.isna(row[col_name]):
-                            data_arrays[col_name][t_idx, r_idx] = row[col_name]
+        # 第二遍逐批读取：时间戳和detid编码为Categorical整数码（不在类别中的为-1），再按指标散射赋值
+        for batch in readings_file.iter_batches(batch_size=READINGS_BATCH_SIZE, columns=['detid', time_column, *data_columns]):
+            batch_df = batch.to_pandas()
+            t_idx = pd.Categorical(batch_df[time_column], categories=timestamps, ordered=True).codes.astype(np.int64)
+            detid_codes = pd.Categorical(batch_df['detid'], categories=detid_categories).codes
+            r_idx = np.full(len(detid_codes), -1, dtype=np.int64)
+            r_idx[detid_codes >= 0] = detid_sensor_idx[detid_codes[detid_codes >= 0]]
+            valid_rows = (t_idx >= 0) & (r_idx >= 0)
+            
+            for col_name in data_columns:
+                values = batch_df[col_name].to_numpy(dtype=np.float64)
+                valid = valid_rows & ~np.isnan(values)
+                data_arrays[col_name][t_idx[valid], r_idx[valid]] = values[valid]
         
         # 9. 准备图结构数据
         adjacency_data = None
         if 'from_node' in network_df.columns and 'to_node' in network_df.columns:
-            print("Building network connectivity...")
-            # 创建节点ID映射
-            unique_nodes = set()
-            for _, road in network_df.iterrows():
-                unique_nodes.add(road['from_node'])
-                unique_nodes.add(road['to_node'])
-            
-            node_to_idx = {node: i for i, node in enumerate(sorted(unique_nodes))}
-            n_nodes = len(node_to_idx)
+            # 创建节点ID映射：一次np.unique同时得到排序后的节点和每条边端点的索引
+            from_arr = network_df['from_node'].to_numpy()
+            to_arr = network_df['to_node'].to_numpy()
+            unique_nodes, inverse = np.unique(np.concatenate([from_arr, to_arr]), return_inverse=True)
             
             # 创建边列表
-            edges = []
-            for _, road in network_df.iterrows():
-                from_idx = node_to_idx[road['from_node']]
-                to_idx = node_to_idx[road['to_node']]
-                edges.append((from_idx, to_idx))
+            edges = np.stack([inverse[:len(from_arr)], inverse[len(from_arr):]], axis=1)
             
             adjacency_data = {
-                'edges': np.array(edges),
-                'node_ids': np.array(list(node_to_idx.keys())),
-                'node_mapping': node_to_idx
+                'edges': edges,
+                'node_ids': unique_nodes  # 节点索引即node_ids中的位置
             }
         
         # 10. 保存道路属性
@@ -174,15 +227,13 @@ def convert_to_optimized_npz(city_folder):
             if col != 'geometry' and col != 'wkb':
                 network_attributes[col] = network_df[col].values
         
-        sensor_attributes = {}
-        for col in sensor_roads.columns:
-            if col != 'geometry' and col != 'wkb':
-                sensor_attributes[col] = sensor_roads[col].values
+        # 传感器道路属性是网络属性的行子集，不再重复保存：
+        # sensor_attributes[col] = network_attributes[col][sensor_to_network_map]
         
         # 11. 保存为npz文件
         save_dict = {
             # 时间数据
-            'timestamps': np.array(timestamps),
+            'timestamps': timestamps,
             
             # 网络数据（完整）
             'network_road_ids': network_df[road_id_col].values,
@@ -192,10 +243,9 @@ def convert_to_optimized_npz(city_folder):
             # 传感器道路数据（子集）
             'sensor_road_ids': sensor_roads[road_id_col].values,
             'sensor_detector_ids': sensor_roads['detid'].values,
-            'sensor_attributes': sensor_attributes,
             
             # 映射关系
-            'network_to_sensor_map': network_to_sensor,  # 网络索引 -> 传感器索引
+            'network_to_sensor_map': network_to_sensor,  # 网络索引 -> 传感器索引（-1表示无传感器）
             'sensor_to_network_map': sensor_to_network,  # 传感器索引 -> 网络索引
             
             # 传感器计数和网络计数
@@ -203,16 +253,23 @@ def convert_to_optimized_npz(city_folder):
             'n_sensor_roads': len(sensor_roads)
         }
         
-        # 添加各指标数据（只针对传感器道路）
+        # 添加各指标数据（只针对传感器道路），以16位整数编码存储
+        # 读取时：原值 = 存储值 / scale，等于nan的存储值还原为NaN
+        metric_encoding = {}
         for col_name, array in data_arrays.items():
-            save_dict[f'sensor_{col_name}'] = array
+            encoded, nan_value, scale = encode_metric(array, METRIC_SCALES[col_name])
+            save_dict[f'sensor_{col_name}'] = encoded
+            metric_encoding[f'sensor_{col_name}'] = {
+                'dtype': encoded.dtype.name, 'scale': scale, 'nan': nan_value
+            }
+        save_dict['metric_encoding'] = np.array(json.dumps(metric_encoding))
         
         # 添加网络连接结构(如果有)
         if adjacency_data:
             for key, value in adjacency_data.items():
                 save_dict[f'network_{key}'] = value
         
-        np.savez_compressed(output_npz, **save_dict)
+        save_npz(output_npz, save_dict)
         
         elapsed_time = time.time() - start_time
         print(f"Successfully converted {city_name} data to NPZ in {elapsed_time:.2f} seconds")
@@ -257,15 +314,15 @@ def main():
     # 从进度文件加载已处理的城市(如果存在)
     processed_cities = set()
     if os.path.exists(progress_file):
-        with open(progress_file, 'r') as f:
-            processed_cities = set(line.strip() for line in f.readlines())
+        processed_cities = set(line.strip() for line in Path(progress_file).read_text().splitlines() if line.strip())
         print(f"Loaded progress: {len(processed_cities)} cities already processed")
     
     # 记录总体进度
     total_cities = len(city_folders)
     successful_count = len(processed_cities)
     
-    # 处理每个城市
+    # 收集待处理的城市，跳过已处理的
+    pending_folders = []
     for city_folder in city_folders:
         city_name = os.path.basename(city_folder)
         
@@ -274,21 +331,36 @@ def main():
             print(f"Skipping {city_name} - already processed")
             continue
         
-        # 转换数据
-        success = convert_to_optimized_npz(city_folder)
+        pending_folders.append(city_folder)
+    
+    # 各城市相互独立，并行转换；进度只在主进程中更新
+    # 只用一半的核，给pyarrow自身的线程池留出余量
+    # 进度文件以追加模式打开一次，每个成功的城市只追加一行
+    with open(progress_file, 'a', buffering=1) as progress_log, \
+            ProcessPoolExecutor(max_workers=max(1, os.cpu_count() // 2)) as executor:
+        futures = {
+            executor.submit(convert_to_optimized_npz, city_folder): city_folder
+            for city_folder in pending_folders
+        }
         
-        # 如果处理成功，记录进度
-        if success:
-            successful_count += 1
-            processed_cities.add(city_name)
+        for future in as_completed(futures):
+            city_name = os.path.basename(futures[future])
             
-            # 更新进度文件
-            with open(progress_file, 'w') as f:
-                for city in processed_cities:
-                    f.write(f"{city}\n")
-        
-        # 显示当前进度
-        print(f"Progress: {successful_count}/{total_cities} cities processed ({successful_count/total_cities*100:.1f}%)\n")
+            # 转换数据
+            try:
+                success = future.result()
+            except Exception as e:
+                print(f"Error converting {city_name} data: {str(e)}")
+                success = False
+            
+            # 如果处理成功，记录进度
+            if success:
+                successful_count += 1
+                processed_cities.add(city_name)
+                progress_log.write(f"{city_name}\n")
+            
+            # 显示当前进度
+            print(f"Progress: {successful_count}/{total_cities} cities processed ({successful_count/total_cities*100:.1f}%)\n")
     
     print(f"Conversion complete! {successful_count}/{total_cities} cities successfully processed.")
     
@@ -303,17 +375,21 @@ def main():
     print("network_detids = data['network_detector_ids']")
     print("")
     print("# 访问传感器数据")
-    print("sensor_flow = data['sensor_flow']  # 时间点 x 传感器道路的矩阵")
+    print("encoding = json.loads(str(data['metric_encoding']))['sensor_flow']")
+    print("sensor_flow = data['sensor_flow'] / encoding['scale']  # 时间点 x 传感器道路的矩阵")
+    print("sensor_flow[data['sensor_flow'] == encoding['nan']] = np.nan")
     print("sensor_detids = data['sensor_detector_ids']")
+    print("network_attributes = data['network_attributes'].item()")
+    print("sensor_lengths = network_attributes['road_length'][data['sensor_to_network_map']]  # 传感器道路属性")
     print("")
     print("# 使用映射关系")
-    print("network_to_sensor = data['network_to_sensor_map'].item()  # 将字典从npz中提取出来")
-    print("sensor_to_network = data['sensor_to_network_map'].item()")
+    print("network_to_sensor = data['network_to_sensor_map']  # 网络索引 -> 传感器索引，-1表示无传感器")
+    print("sensor_to_network = data['sensor_to_network_map']  # 传感器索引 -> 网络索引")
     print("")
     print("# 示例：根据网络索引找到对应的传感器数据")
     print("network_idx = 42  # 道路网络中的某个道路索引")
-    print("if network_idx in network_to_sensor:")
-    print("    sensor_idx = network_to_sensor[network_idx]")
+    print("sensor_idx = network_to_sensor[network_idx]")
+    print("if sensor_idx >= 0:")
     print("    flow_data = sensor_flow[:, sensor_idx]  # 该道路的所有时间点流量数据")
     print("```")
 
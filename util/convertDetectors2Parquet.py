@@ -2,8 +2,9 @@ import os
 import glob
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point
+import shapely
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 
 def convert_detector_csv_to_parquet(city_folder):
@@ -18,7 +19,6 @@ def convert_detector_csv_to_parquet(city_folder):
     - bool: 是否成功转换
     """
     city_name = os.path.basename(city_folder)
-    print(f"Processing {city_name} detector data...")
     
     # 文件路径定义
     csv_file = os.path.join(city_folder, "detectors_public.csv")
@@ -46,8 +46,7 @@ def convert_detector_csv_to_parquet(city_folder):
             detector_df.to_parquet(parquet_file, index=False)
         else:
             # 创建点几何对象
-            print(f"  Creating point geometry from long/lat coordinates")
-            geometry = [Point(x, y) for x, y in zip(detector_df['long'], detector_df['lat'])]
+            geometry = shapely.points(detector_df['long'].to_numpy(), detector_df['lat'].to_numpy())
             
             # 转换为GeoDataFrame
             geo_detector_df = gpd.GeoDataFrame(
@@ -56,20 +55,21 @@ def convert_detector_csv_to_parquet(city_folder):
                 crs="EPSG:4326"  # WGS84坐标系
             )
             
-            # 打印一些基本信息
-            print(f"  Successfully created geometry for {len(geo_detector_df)} detectors in {city_name}")
-            
-            # 保存为Parquet格式
-            geo_detector_df.to_parquet(parquet_file, index=False)
+            # 保存为Parquet格式：GeoArrow原生几何编码（读取时无需解析WKB）、bbox列支持空间过滤
+            geo_detector_df.to_parquet(
+                parquet_file, index=False,
+                geometry_encoding='geoarrow', write_covering_bbox=True, compression='zstd'
+            )
         
         # 计算文件大小减少
         csv_size = os.path.getsize(csv_file) / 1024  # KB
         parquet_size = os.path.getsize(parquet_file) / 1024  # KB
         reduction = (1 - parquet_size / csv_size) * 100 if csv_size > 0 else 0
         
+        # 每个城市只输出一行汇总
         elapsed_time = time.time() - start_time
-        print(f"  Converted in {elapsed_time:.2f} seconds")
-        print(f"  File size: CSV={csv_size:.2f}KB, Parquet={parquet_size:.2f}KB ({reduction:.1f}% reduction)")
+        print(f"Converted {len(detector_df)} detectors for {city_name} in {elapsed_time:.2f} seconds - "
+              f"CSV={csv_size:.2f}KB, Parquet={parquet_size:.2f}KB ({reduction:.1f}% reduction)")
         
         return True
     
@@ -95,15 +95,15 @@ def main():
     # 从进度文件加载已处理的城市(如果存在)
     processed_cities = set()
     if os.path.exists(progress_file):
-        with open(progress_file, 'r') as f:
-            processed_cities = set(line.strip() for line in f.readlines())
+        processed_cities = set(line.strip() for line in Path(progress_file).read_text().splitlines() if line.strip())
         print(f"Loaded progress: {len(processed_cities)} cities already processed")
     
     # 记录总体进度
     total_cities = len(city_folders)
     successful_count = len(processed_cities)
     
-    # 处理每个城市
+    # 收集待处理的城市，跳过已处理的
+    pending_folders = []
     for city_folder in city_folders:
         city_name = os.path.basename(city_folder)
         
@@ -112,21 +112,36 @@ def main():
             print(f"Skipping {city_name} - already in progress file")
             continue
         
-        # 处理城市数据
-        success = convert_detector_csv_to_parquet(city_folder)
+        pending_folders.append(city_folder)
+    
+    # 各城市相互独立，并行转换；进度只在主进程中更新
+    # 只用一半的核，给pyarrow自身的线程池留出余量
+    # 进度文件以追加模式打开一次，每个成功的城市只追加一行
+    with open(progress_file, 'a', buffering=1) as progress_log, \
+            ProcessPoolExecutor(max_workers=max(1, os.cpu_count() // 2)) as executor:
+        futures = {
+            executor.submit(convert_detector_csv_to_parquet, city_folder): city_folder
+            for city_folder in pending_folders
+        }
         
-        # 如果处理成功，记录进度
-        if success:
-            successful_count += 1
-            processed_cities.add(city_name)
+        for future in as_completed(futures):
+            city_name = os.path.basename(futures[future])
             
-            # 更新进度文件
-            with open(progress_file, 'w') as f:
-                for city in processed_cities:
-                    f.write(f"{city}\n")
-        
-        # 显示当前进度
-        print(f"Progress: {successful_count}/{total_cities} cities processed ({successful_count/total_cities*100:.1f}%)")
+            # 处理城市数据
+            try:
+                success = future.result()
+            except Exception as e:
+                print(f"Error converting {city_name} detectors: {str(e)}")
+                success = False
+            
+            # 如果处理成功，记录进度
+            if success:
+                successful_count += 1
+                processed_cities.add(city_name)
+                progress_log.write(f"{city_name}\n")
+            
+            # 显示当前进度
+            print(f"Progress: {successful_count}/{total_cities} cities processed ({successful_count/total_cities*100:.1f}%)")
     
     print(f"Conversion complete! {successful_count}/{total_cities} cities successfully processed.")
     
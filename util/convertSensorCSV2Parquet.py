@@ -1,8 +1,24 @@
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 import pandas as pd
 import os
 import glob
 from pathlib import Path
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# day列的常见格式；不符合时退回pandas的格式推断
+DAY_FORMAT = '%Y-%m-%d'
+
+def parse_day(day):
+    """将字符串形式的day列解析为秒级时间戳，格式不是DAY_FORMAT时与原先一样交给pd.to_datetime推断"""
+    try:
+        return pc.strptime(day, format=DAY_FORMAT, unit='s')
+    except pa.ArrowInvalid:
+        parsed = pd.to_datetime(day.to_pandas())
+        return pa.chunked_array([pa.array(parsed, type=pa.timestamp('s'))])
 
 def convert_csv_to_parquet(csv_file, output_file):
     """
@@ -16,34 +32,51 @@ def convert_csv_to_parquet(csv_file, output_file):
     - bool: 是否成功转换
     """
     try:
-        # 读取CSV文件
-        df = pd.read_csv(csv_file)
+        # 多线程读取CSV文件，直接得到Arrow列式数据
+        table = pacsv.read_csv(
+            csv_file,
+            read_options=pacsv.ReadOptions(use_threads=True, block_size=64 << 20),
+            convert_options=pacsv.ConvertOptions(column_types={
+                'day': pa.string(),
+                'interval': pa.int32(),
+                'flow': pa.float32(),
+                'occ': pa.float32(),
+                'speed': pa.float32(),
+                'error': pa.float32(),
+                'detid': pa.string(),
+                'city': pa.string()
+            })
+        )
         
         # 确保所需的列存在
         required_cols = ['day', 'interval', 'detid', 'flow', 'occ', 'city']
         for col in required_cols:
-            if col not in df.columns:
+            if col not in table.column_names:
                 print(f"Error: Required column '{col}' not found in {csv_file}")
                 return False
         
         # 添加缺失的列(如果需要)
-        if 'error' not in df.columns:
-            df['error'] = None
-        if 'speed' not in df.columns:
-            df['speed'] = None
+        for col in ['error', 'speed']:
+            if col not in table.column_names:
+                table = table.append_column(col, pa.nulls(len(table), pa.float32()))
         
-        # 转换日期时间
-        df['day'] = pd.to_datetime(df['day'])
-        df['datetime'] = df['day'] + pd.to_timedelta(df['interval'], unit='s')
-        
-        # 格式化日期时间为DD/MM/YYYY HH:MM:SS
-        df['datetime'] = df['datetime'].dt.strftime('%d/%m/%Y %H:%M:%S')
+        # 转换日期时间：day + interval(秒)，保留原生时间戳类型
+        interval = pc.cast(pc.cast(table['interval'], pa.int64()), pa.duration('s'))
+        datetime = pc.add(parse_day(table['day']), interval)
         
         # 选择并重命名列
-        result_df = df[['datetime', 'detid', 'flow', 'occ', 'speed', 'error', 'city']]
+        result_table = pa.table({
+            'datetime': datetime,
+            'detid': table['detid'],
+            'flow': table['flow'],
+            'occ': table['occ'],
+            'speed': table['speed'],
+            'error': table['error'],
+            'city': table['city']
+        })
         
         # 保存为Parquet文件
-        result_df.to_parquet(output_file, index=False)
+        pq.write_table(result_table, output_file, compression='zstd')
         
         return True
     
@@ -51,6 +84,32 @@ def convert_csv_to_parquet(csv_file, output_file):
         print(f"Error converting {csv_file}: {str(e)}")
         return False
 
+def convert_city_folder(city_folder):
+    """转换单个城市文件夹中的传感器CSV文件"""
+    city_name = os.path.basename(city_folder)
+    
+    # 构建文件路径
+    csv_file = os.path.join(city_folder, f"{city_name}.csv")
+    parquet_file = os.path.join(city_folder, f"5min_readings.parquet")
+    
+    if not os.path.exists(csv_file):
+        print(f"No sensor CSV file found for {city_name}")
+        return False
+    
+    print(f"Processing {city_name}...")
+    start_time = time.time()
+    
+    # 转换文件
+    success = convert_csv_to_parquet(csv_file, parquet_file)
+    
+    if success:
+        elapsed_time = time.time() - start_time
+        print(f"Converted {city_name} in {elapsed_time:.2f} seconds")
+    else:
+        print(f"Failed to convert {city_name}")
+    
+    return success
+
 def process_city_folders(data_root):
     """处理所有城市文件夹，转换CSV到Parquet"""
     # 获取所有城市文件夹
@@ -64,15 +123,15 @@ def process_city_folders(data_root):
     # 从进度文件加载已处理的城市(如果存在)
     processed_cities = set()
     if os.path.exists(progress_file):
-        with open(progress_file, 'r') as f:
-            processed_cities = set(line.strip() for line in f.readlines())
+        processed_cities = set(line.strip() for line in Path(progress_file).read_text().splitlines() if line.strip())
         print(f"Loaded progress: {len(processed_cities)} cities already processed")
     
     # 记录总体进度
     total_cities = len(city_folders)
     successful_count = len(processed_cities)
     
-    # 处理每个城市
+    # 收集待处理的城市，跳过已处理的
+    pending_folders = []
     for city_folder in city_folders:
         city_name = os.path.basename(city_folder)
         
@@ -81,37 +140,36 @@ def process_city_folders(data_root):
             print(f"Skipping {city_name} - already processed")
             continue
         
-        # 构建文件路径
-        csv_file = os.path.join(city_folder, f"{city_name}.csv")
-        parquet_file = os.path.join(city_folder, f"5min_readings.parquet")
-        
-        if not os.path.exists(csv_file):
-            print(f"No sensor CSV file found for {city_name}")
-            continue
-        
-        print(f"Processing {city_name}...")
-        start_time = time.time()
-        
-        # 转换文件
-        success = convert_csv_to_parquet(csv_file, parquet_file)
+        pending_folders.append(city_folder)
+    
+    # 各城市相互独立，并行转换；进度只在主进程中更新
+    # 只用一半的核，给pyarrow自身的线程池留出余量
+    # 进度文件以追加模式打开一次，每个成功的城市只追加一行
+    with open(progress_file, 'a', buffering=1) as progress_log, \
+            ProcessPoolExecutor(max_workers=max(1, os.cpu_count() // 2)) as executor:
+        futures = {
+            executor.submit(convert_city_folder, city_folder): city_folder
+            for city_folder in pending_folders
+        }
         
-        if success:
-            elapsed_time = time.time() - start_time
-            print(f"Converted {city_name} in {elapsed_time:.2f} seconds")
+        for future in as_completed(futures):
+            city_name = os.path.basename(futures[future])
             
-            # 更新进度
-            successful_count += 1
-            processed_cities.add(city_name)
+            # 转换文件
+            try:
+                success = future.result()
+            except Exception as e:
+                print(f"Error converting {city_name}: {str(e)}")
+                success = False
             
-            # 保存进度
-            with open(progress_file, 'w') as f:
-                for city in processed_cities:
-                    f.write(f"{city}\n")
-        else:
-            print(f"Failed to convert {city_name}")
-        
-        # 显示进度
-        print(f"Progress: {successful_count}/{total_cities} cities ({successful_count/total_cities*100:.1f}%)")
+            if success:
+                # 更新进度
+                successful_count += 1
+                processed_cities.add(city_name)
+                progress_log.write(f"{city_name}\n")
+            
+            # 显示进度
+            print(f"Progress: {successful_count}/{total_cities} cities ({successful_count/total_cities*100:.1f}%)")
     
     print(f"Conversion complete. {successful_count}/{total_cities} cities successfully processed.")
     
@@ -1,12 +1,128 @@
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import pyogrio
 import os
-import networkx as nx
+import sys
+import json
 from pathlib import Path
-from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from shapely.geometry import Point, LineString
 
+sys.path.append('.')  # Ensure the current directory is in the path
+from util.convertConnectivity2Npz import METRIC_SCALES, encode_metric
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit
+    def _neighbor_pairs(n, w):
+        """按 (i, j) 顺序生成位置相距不超过w的传感器对（不含自身）"""
+        from_pos = np.empty(n * 2 * w, dtype=np.int64)
+        to_pos = np.empty(n * 2 * w, dtype=np.int64)
+        k = 0
+        for i in range(n):
+            for j in range(max(0, i - w), min(n, i + w + 1)):
+                if i == j:
+                    continue
+                from_pos[k] = i
+                to_pos[k] = j
+                k += 1
+        return from_pos[:k], to_pos[:k]
+
+def _neighbor_pairs_numpy(n, w):
+    """_neighbor_pairs的NumPy实现（未安装numba时使用），输出顺序相同"""
+    i = np.repeat(np.arange(n, dtype=np.int64), 2 * w)
+    j = i + np.tile(np.concatenate([np.arange(-w, 0), np.arange(1, w + 1)]), n)
+    valid = (j >= 0) & (j < n)
+    return i[valid], j[valid]
+
+def load_sensor_metric(data, name):
+    """读取传感器指标矩阵，按metric_encoding还原16位编码的数据（旧文件直接返回原数组）"""
+    array = data[name]
+    if 'metric_encoding' not in data.files:
+        return array
+    encoding = json.loads(str(data['metric_encoding']))[name]
+    decoded = array.astype(np.float32) / encoding['scale']
+    decoded[array == encoding['nan']] = np.nan
+    return decoded
+
+def materialize_pems_data(data):
+    """
+    将稀疏保存的 {city}_data.npz 还原为 (时间戳, 道路数, 3) 的稠密数组，没有传感器的道路填充-1
+    
+    旧版本生成的文件直接保存了稠密的data数组，原样返回
+    """
+    if 'data' in data.files:
+        return data['data']
+    road_ids = data['road_ids']
+    sensor_road_indices = data['sensor_road_indices']
+    flow = load_sensor_metric(data, 'flow')
+    full_data = np.full((flow.shape[0], len(road_ids), 3), -1, dtype=np.float32)
+    full_data[:, sensor_road_indices, :] = np.stack(
+        [flow, load_sensor_metric(data, 'speed'), load_sensor_metric(data, 'occ')], axis=-1)
+    return full_data
+
+def save_pems_data(npz_path, road_ids, sensor_road_indices, flow, speed, occ):
+    """
+    保存 {city}_data.npz：流量、速度、占有率按METRIC_SCALES量化为16位整数（scale按数据范围自动降低），编码信息写入metric_encoding
+    
+    不压缩，避免对整个数组做单线程DEFLATE
+    """
+    save_dict = {
+        'road_ids': np.asarray(road_ids),
+        'sensor_road_indices': np.asarray(sensor_road_indices, dtype=np.int32),
+    }
+    metric_encoding = {}
+    for name, array in (('flow', flow), ('speed', speed), ('occ', occ)):
+        encoded, nan_value, scale = encode_metric(array, METRIC_SCALES[name])
+        save_dict[name] = encoded
+        metric_encoding[name] = {'dtype': encoded.dtype.name, 'scale': scale, 'nan': nan_value}
+    save_dict['metric_encoding'] = np.array(json.dumps(metric_encoding))
+    np.savez(npz_path, **save_dict)
+
+def lookup_road_index(road_ids, query_ids):
+    """
+    返回query_ids中每个ID在road_ids中的位置，不存在时为-1（ID重复时取最后一次出现的位置）
+    
+    ID较为紧凑时以road_id为下标建立查找表；ID稀疏、查找表过大时改用pandas的哈希索引
+    """
+    road_ids = np.asarray(road_ids, dtype=np.int64)
+    query_ids = np.asarray(query_ids, dtype=np.int64)
+    result = np.full(len(query_ids), -1, dtype=np.int64)
+    if len(road_ids) == 0:
+        return result
+    
+    min_id, max_id = road_ids.min(), road_ids.max()
+    if min_id >= 0 and max_id < 4 * len(road_ids) + 1024:
+        lut = np.full(max_id + 1, -1, dtype=np.int64)
+        lut[road_ids] = np.arange(len(road_ids))
+        in_range = (query_ids >= 0) & (query_ids <= max_id)
+        result[in_range] = lut[query_ids[in_range]]
+        return result
+    
+    # 重复ID只保留最后一次出现，与查找表的结果一致
+    positions = pd.Series(np.arange(len(road_ids)), index=road_ids)
+    positions = positions[~positions.index.duplicated(keep='last')]
+    found = positions.index.get_indexer(query_ids)
+    result[found >= 0] = positions.to_numpy()[found[found >= 0]]
+    return result
+
+def save_distance(connections_df, distance_path):
+    """保存 {city}_distance.parquet：节点ID能放入int32时存为int32，距离存为float32，zstd压缩"""
+    connections_df = connections_df.copy()
+    for col in ('from_node', 'to_node'):
+        values = connections_df[col].to_numpy()
+        if not np.issubdtype(values.dtype, np.integer):
+            continue
+        if len(values) == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+            connections_df[col] = values.astype(np.int32)
+    connections_df['distance'] = connections_df['distance'].astype(np.float32)
+    connections_df.to_parquet(distance_path, index=False, compression='zstd')
+
 def convert_to_pems_format(city_name, output_dir=None):
     """
     将城市交通数据转换为类似PEMS格式
@@ -16,8 +132,8 @@ def convert_to_pems_format(city_name, output_dir=None):
     - output_dir: 输出目录，默认为"data/debug/pems_format/{city_name}"
     
     输出:
-    - {city_name}_distance.csv: 包含from_node, to_node, distance三列的CSV文件
-    - {city_name}_data.npz: 包含流量、速度、占有率的NPZ文件
+    - {city_name}_distance.parquet: 包含from_node, to_node, distance三列的Parquet文件
+    - {city_name}_data.npz: 包含流量、速度、占有率的NPZ文件（仅保存有传感器的道路，用materialize_pems_data还原为稠密数组）
     """
     # 设置路径
     if output_dir is None:
@@ -41,9 +157,9 @@ def convert_to_pems_format(city_name, output_dir=None):
     
     # 获取传感器数据
     if 'sensor_flow' in data.files and 'sensor_speed' in data.files and 'sensor_occ' in data.files:
-        sensor_flow = data['sensor_flow']  # 流量数据
-        sensor_speed = data['sensor_speed']  # 速度数据
-        sensor_occ = data['sensor_occ']  # 占有率数据
+        sensor_flow = load_sensor_metric(data, 'sensor_flow').astype(np.float32, copy=False)  # 流量数据
+        sensor_speed = load_sensor_metric(data, 'sensor_speed').astype(np.float32, copy=False)  # 速度数据
+        sensor_occ = load_sensor_metric(data, 'sensor_occ').astype(np.float32, copy=False)  # 占有率数据
         
         # 检查数据维度
         print(f"传感器流量数据形状: {sensor_flow.shape}")
@@ -81,74 +197,47 @@ def convert_to_pems_format(city_name, output_dir=None):
                         road_lengths[road_id] = float(network_attr['road_length'][i])
                 print(f"从network_attributes中加载了更多道路长度信息，总计{len(road_lengths)}条")
         
-        # 将传感器ID转换为集合，以便快速查找
-        sensor_id_set = set(map(int, sensor_ids))
+        # 传感器ID统一转换为整数，只转换一次
+        sensor_ids_int = np.asarray(sensor_ids, dtype=np.int64)
         
         # 使用完整的GeoJSON数据创建道路网络
         try:
             # 加载GeoJSON数据
             if os.path.exists(geojson_path):
                 print(f"加载GeoJSON数据: {geojson_path}")
-                roads_gdf = gpd.read_file(geojson_path)
+                # 只读取道路ID和长度相关的列（保留ID/长度列的回退查找），跳过其余OSM属性
+                fields = pyogrio.read_info(geojson_path)['fields']
+                columns = [col for col in fields if 'id' in col.lower() or 'length' in col.lower()]
+                roads_gdf = gpd.read_file(geojson_path, engine='pyogrio', columns=columns)
                 print(f"GeoJSON数据形状: {roads_gdf.shape}")
                 print(f"GeoJSON数据列: {roads_gdf.columns.tolist()}")
                 
-                # 创建网络图
-                G, all_road_ids, road_length_dict = create_road_network_from_geojson(roads_gdf)
-                print(f"创建了包含 {len(all_road_ids)} 条道路的网络")
+                # 创建道路连接关系
+                connections_df, all_road_ids, road_length_dict = create_road_network_from_geojson(roads_gdf)
+                print(f"从GeoJSON创建了 {len(connections_df)} 个道路连接")
                 
-                # 创建连接关系
-                print("从道路网络图中提取连接关系...")
-                connections = []
-                for u, v, data in G.edges(data=True):
-                    # 直接使用GeoJSON中的road_length而不是计算距离
-                    from_length = road_length_dict.get(u, 50.0)
-                    to_length = road_length_dict.get(v, 50.0)
-                    # 对于边，使用实际的道路长度而不是计算的距离
-                    distance = data.get('road_length', max(from_length, to_length))
-                    
-                    connections.append({
-                        'from_node': u,
-                        'to_node': v,
-                        'distance': distance
-                    })
-                
-                print(f"从GeoJSON创建了 {len(connections)} 个道路连接")
-                
-                # 创建包含所有道路的数据数组
-                n_timestamps = len(timestamps) if timestamps is not None else sensor_flow.shape[0]
                 n_roads = len(all_road_ids)
                 
-                print(f"创建形状为 ({n_timestamps}, {n_roads}, 3) 的数据数组...")
-                
-                # 创建一个映射，将road_id映射到在all_road_ids中的索引
-                road_id_to_index = {road_id: i for i, road_id in enumerate(all_road_ids)}
-                
-                # 创建数据数组，初始化为-1（表示没有传感器数据）
-                full_data = np.full((n_timestamps, n_roads, 3), -1, dtype=np.float32)
-                
-                # 为有传感器的道路填充实际数据
-                for i, sensor_id in enumerate(sensor_ids):
-                    int_sensor_id = int(sensor_id)
-                    if int_sensor_id in road_id_to_index:
-                        idx = road_id_to_index[int_sensor_id]
-                        full_data[:, idx, 0] = sensor_flow[:, i]  # 流量
-                        full_data[:, idx, 1] = sensor_speed[:, i]  # 速度
-                        full_data[:, idx, 2] = sensor_occ[:, i]    # 占有率
+                # 求出有传感器的道路：传感器列位置src_arr与道路索引idx_arr一一对应
+                # 数据只保存这些道路，不再生成以-1填充的 (时间戳, 道路数, 3) 稠密数组
+                road_ids_arr = np.asarray(all_road_ids, dtype=np.int64)
+                sensor_road_index = lookup_road_index(road_ids_arr, sensor_ids_int)
+                src_arr = np.flatnonzero(sensor_road_index >= 0)
+                idx_arr = sensor_road_index[src_arr]
                 
                 # 检查有多少道路有实际的传感器数据
-                has_data_count = sum(1 for road_id in all_road_ids if road_id in sensor_id_set)
+                has_data_count = int(np.isin(road_ids_arr, sensor_ids_int).sum())
                 print(f"在 {n_roads} 条道路中，有 {has_data_count} 条道路有传感器数据")
                 
-                # 保存连接和距离为CSV
-                connections_df = pd.DataFrame(connections)
-                distance_path = os.path.join(output_dir, f"{city_name}_distance.csv")
-                connections_df.to_csv(distance_path, index=False)
+                # 保存连接和距离为Parquet
+                distance_path = os.path.join(output_dir, f"{city_name}_distance.parquet")
+                save_distance(connections_df, distance_path)
                 print(f"距离数据已保存至: {distance_path}")
                 
                 # 保存为NPZ格式
                 npz_path = os.path.join(output_dir, f"{city_name}_data.npz")
-                np.savez_compressed(npz_path, data=full_data)
+                save_pems_data(npz_path, all_road_ids, idx_arr,
+                               sensor_flow[:, src_arr], sensor_speed[:, src_arr], sensor_occ[:, src_arr])
                 print(f"数据已保存至: {npz_path}")
                 
                 # 保存元数据（包括所有道路ID）
@@ -158,7 +247,7 @@ def convert_to_pems_format(city_name, output_dir=None):
                     "sensor_road_ids": sensor_ids,  # 保留原始传感器ID以供参考
                 }
                 meta_path = os.path.join(output_dir, f"{city_name}_meta.npz")
-                np.savez_compressed(meta_path, **meta_data)
+                np.savez(meta_path, **meta_data)
                 print(f"元数据已保存至: {meta_path}")
                 
                 print(f"{city_name} 数据转换完成!")
@@ -172,25 +261,16 @@ def convert_to_pems_format(city_name, output_dir=None):
         print("回退到只使用传感器数据...")
         
         # 创建基本连接关系
-        connections = create_connections_from_road_lengths(sensor_ids, road_lengths)
+        connections_df = create_connections_from_road_lengths(sensor_ids_int, road_lengths)
         
-        # 保存连接和距离为CSV
-        connections_df = pd.DataFrame(connections)
-        distance_path = os.path.join(output_dir, f"{city_name}_distance.csv")
-        connections_df.to_csv(distance_path, index=False)
+        # 保存连接和距离为Parquet
+        distance_path = os.path.join(output_dir, f"{city_name}_distance.parquet")
+        save_distance(connections_df, distance_path)
         print(f"距离数据已保存至: {distance_path}")
         
-        # 将原始数据转换为三维数组 [时间戳, 节点数, 特征]
-        n_timestamps, n_sensors = sensor_flow.shape
-        pems_data = np.zeros((n_timestamps, n_sensors, 3), dtype=np.float32)
-        
-        pems_data[:, :, 0] = sensor_flow  # 流量
-        pems_data[:, :, 1] = sensor_speed  # 速度
-        pems_data[:, :, 2] = sensor_occ    # 占有率
-        
-        # 保存为NPZ格式
+        # 保存为NPZ格式，每个传感器即一个节点
         npz_path = os.path.join(output_dir, f"{city_name}_data.npz")
-        np.savez_compressed(npz_path, data=pems_data)
+        save_pems_data(npz_path, sensor_ids, np.arange(len(sensor_ids)), sensor_flow, sensor_speed, sensor_occ)
         print(f"数据已保存至: {npz_path}")
         
         # 保存元数据
@@ -200,7 +280,7 @@ def convert_to_pems_format(city_name, output_dir=None):
                 "road_ids": sensor_ids,
             }
             meta_path = os.path.join(output_dir, f"{city_name}_meta.npz")
-            np.savez_compressed(meta_path, **meta_data)
+            np.savez(meta_path, **meta_data)
             print(f"元数据已保存至: {meta_path}")
         
         print(f"{city_name} 数据转换完成! (使用备用方法)")
@@ -210,21 +290,18 @@ def convert_to_pems_format(city_name, output_dir=None):
 
 def create_road_network_from_geojson(roads_gdf):
     """
-    从GeoJSON道路数据创建网络图
+    从GeoJSON道路数据创建道路连接关系
     
     参数:
     - roads_gdf: 包含道路几何信息的GeoDataFrame
     
     返回:
-    - G: NetworkX图对象
+    - connections_df: 包含from_node, to_node, distance三列的DataFrame
     - all_road_ids: 所有道路ID的列表
     - road_length_dict: 道路ID到长度的映射字典
     """
     print("从GeoJSON创建道路网络...")
     
-    # 创建一个空的无向图
-    G = nx.Graph()
-    
     # 检查必要的列
     if 'road_id' not in roads_gdf.columns:
         # 尝试找到可能的ID列
@@ -255,55 +332,37 @@ def create_road_network_from_geojson(roads_gdf):
             # 计算几何长度 (注意: 在EPSG:4326中可能不准确)
             roads_gdf['road_length'] = roads_gdf.geometry.length * 111000  # 粗略转换为米
     
-    # 创建道路ID到长度的映射
-    road_length_dict = {}
+    # 道路ID与长度
+    ids = roads_gdf['road_id'].to_numpy()
+    lengths = roads_gdf['road_length'].to_numpy(dtype=np.float64)
+    all_road_ids = ids.tolist()
     
-    # 将道路添加为节点
-    all_road_ids = []
-    for idx, row in tqdm(roads_gdf.iterrows(), total=len(roads_gdf), desc="添加道路节点"):
-        road_id = row['road_id']
-        road_length = row['road_length']
-        
-        G.add_node(road_id, geometry=row.geometry, road_length=road_length)
-        all_road_ids.append(road_id)
-        road_length_dict[road_id] = road_length
+    # 创建道路ID到长度的映射
+    road_length_dict = dict(zip(all_road_ids, lengths.tolist()))
     
     # 查找相交的道路并添加为边
     print("查找相交的道路...")
-    # 创建一个R树索引以加速空间查询
-    sindex = roads_gdf.sindex
-    
-    # 对于每条道路，找到与其相交的其他道路
-    for idx, row in tqdm(roads_gdf.iterrows(), total=len(roads_gdf), desc="寻找道路连接"):
-        road_id = row['road_id']
-        road_length = row['road_length']
-        geom = row.geometry
-        
-        # 使用空间索引查找可能相交的道路
-        possible_matches_idx = list(sindex.intersection(geom.bounds))
-        possible_matches = roads_gdf.iloc[possible_matches_idx]
-        
-        # 筛选出实际相交的道路
-        for idx2, row2 in possible_matches.iterrows():
-            if idx == idx2:
-                continue  # 跳过自身
-                
-            road_id2 = row2['road_id']
-            road_length2 = row2['road_length']
-            geom2 = row2.geometry
-            
-            if geom.intersects(geom2):
-                # 直接使用road_length作为边属性，而不是计算任何距离
-                # 使用两条道路中较长的一条作为连接长度
-                edge_length = max(road_length, road_length2)
-                
-                # 添加边
-                G.add_edge(road_id, road_id2, weight=edge_length, road_length=edge_length)
+    # 利用R树索引一次性批量查询所有相交的道路对（返回位置索引）
+    left, right = roads_gdf.sindex.query(roads_gdf.geometry.values, predicate='intersects')
+    
+    # 相交关系是对称的，每对道路会以 (u, v) 和 (v, u) 各出现一次
+    # 只保留 u < v 的方向，同时去掉自身相交
+    keep = left < right
+    u_idx, v_idx = left[keep], right[keep]
     
-    print(f"道路网络创建完成，共有 {G.number_of_nodes()} 个节点和 {G.number_of_edges()} 条边")
+    # 直接使用road_length作为边属性，而不是计算任何距离
+    # 使用两条道路中较长的一条作为连接长度
+    edge_len = np.maximum(lengths[u_idx], lengths[v_idx])
+    connections_df = pd.DataFrame({
+        'from_node': ids[u_idx],
+        'to_node': ids[v_idx],
+        'distance': edge_len
+    })
     
-    # 返回图和所有道路ID的列表以及道路长度字典
-    return G, all_road_ids, road_length_dict
+    print(f"道路网络创建完成，共有 {len(all_road_ids)} 个节点和 {len(connections_df)} 条边")
+    
+    # 返回连接关系、所有道路ID的列表以及道路长度字典
+    return connections_df, all_road_ids, road_length_dict
 
 def create_connections_from_road_lengths(sensor_ids, road_lengths):
     """
@@ -312,59 +371,72 @@ def create_connections_from_road_lengths(sensor_ids, road_lengths):
     使用启发式方法：ID接近的道路可能在空间上也接近
     """
     print("使用备用方法创建道路连接...")
-    connections = []
-    n_sensors = len(sensor_ids)
     
     # 为每个传感器创建到其他传感器的连接
     # 仅连接ID相近的传感器 (作为简单的空间临近性启发式方法)
     max_neighbor_distance = 5  # 仅连接ID距离不超过5的传感器
     
-    for i in range(n_sensors):
-        source_id = int(sensor_ids[i])
-        source_len = road_lengths.get(source_id, 50.0)  # 如果没有长度信息，使用默认值
-        
-        # 连接到ID临近的节点
-        for j in range(max(0, i-max_neighbor_distance), min(n_sensors, i+max_neighbor_distance+1)):
-            if i == j:
-                continue  # 跳过自身连接
-            
-            target_id = int(sensor_ids[j])
-            target_len = road_lengths.get(target_id, 50.0)
-            
-            # 使用两条道路中较长的一条作为连接长度
-            distance = max(source_len, target_len)
-            
-            connections.append({
-                'from_node': source_id,
-                'to_node': target_id,
-                'distance': distance
-            })
-    
-    print(f"备用方法创建了 {len(connections)} 个道路连接")
-    return connections
+    ids = np.asarray(sensor_ids, dtype=np.int64)
+    # 如果没有长度信息，使用默认值
+    lens = np.array([road_lengths.get(s, 50.0) for s in ids.tolist()], dtype=np.float64)
+    
+    if njit is not None:
+        from_pos, to_pos = _neighbor_pairs(len(ids), max_neighbor_distance)
+    else:
+        from_pos, to_pos = _neighbor_pairs_numpy(len(ids), max_neighbor_distance)
+    
+    # 使用两条道路中较长的一条作为连接长度
+    connections_df = pd.DataFrame({
+        'from_node': ids[from_pos],
+        'to_node': ids[to_pos],
+        'distance': np.maximum(lens[from_pos], lens[to_pos])
+    })
+    
+    print(f"备用方法创建了 {len(connections_df)} 个道路连接")
+    return connections_df
 
-def process_all_cities():
-    """处理所有可用城市的数据"""
+def process_all_cities(max_workers=None):
+    """
+    处理所有可用城市的数据
+    
+    各城市相互独立，用多进程并行转换；max_workers=1时在当前进程中逐个处理，便于调试
+    """
     iutfd_dir = Path("data/debug/IUTFD")
     
     # 获取所有城市目录
-    city_dirs = [d for d in iutfd_dir.iterdir() if d.is_dir()]
-    city_names = [d.name for d in city_dirs]
+    with os.scandir(iutfd_dir) as entries:
+        city_names = [entry.name for entry in entries if entry.is_dir()]
     
     print(f"找到 {len(city_names)} 个城市")
     
+    # 检查是否存在NPZ文件
+    pending_cities = []
     for city in city_names:
-        try:
-            # 检查是否存在NPZ文件
-            npz_file = iutfd_dir / city / "npz" / f"{city}_traffic_network.npz"
-            if not npz_file.exists():
-                print(f"跳过 {city} - 未找到 {city}_traffic_network.npz")
-                continue
-            
-            # 处理该城市的数据
-            convert_to_pems_format(city)
-        except Exception as e:
-            print(f"处理 {city} 时出错: {str(e)}")
+        npz_file = iutfd_dir / city / "npz" / f"{city}_traffic_network.npz"
+        if not npz_file.exists():
+            print(f"跳过 {city} - 未找到 {city}_traffic_network.npz")
+            continue
+        pending_cities.append(city)
+    
+    if max_workers is None:
+        max_workers = max(1, os.cpu_count() // 2)
+    
+    if max_workers == 1:
+        for city in pending_cities:
+            try:
+                convert_to_pems_format(city)
+            except Exception as e:
+                print(f"处理 {city} 时出错: {str(e)}")
+        return
+    
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(convert_to_pems_format, city): city for city in pending_cities}
+        
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"处理 {futures[future]} 时出错: {str(e)}")
 
 if __name__ == "__main__":
     # 处理单个城市
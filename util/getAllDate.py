@@ -5,8 +5,8 @@ from pathlib import Path
 def get_all_unique_dates():
     # 设置数据集根目录
     root_dir = r"data\debug\input"
-    # 使用字典来存储日期和对应的城市
-    date_sources = {}
+    # 收集每个城市的日期
+    frames = []
 
     # 遍历根目录下的所有城市文件夹
     for city_dir in os.listdir(root_dir):
@@ -18,25 +18,21 @@ def get_all_unique_dates():
             
             # 检查rainfall_data.csv是否存在
             if os.path.exists(rainfall_file):
-                # 读取CSV文件
-                df = pd.read_csv(rainfall_file)
-                # 获取该城市的所有日期
-                for date in df['date'].unique():
-                    if date in date_sources:
-                        date_sources[date].add(city_dir)
-                    else:
-                        date_sources[date] = {city_dir}
+                # 只读取日期列
+                df = pd.read_csv(rainfall_file, usecols=['date'], dtype={'date': 'string'})
+                frames.append(df.assign(city=city_dir))
 
-    # 创建包含日期和数据来源的列表
-    data_list = []
-    for date in sorted(date_sources.keys()):
-        data_list.append({
-            'date': date,
-            'datasource': ';'.join(sorted(date_sources[date]))
-        })
-    
-    # 创建DataFrame
-    dates_df = pd.DataFrame(data_list)
+    # 按日期分组，合并每个日期对应的城市作为数据来源
+    if frames:
+        all_df = pd.concat(frames, ignore_index=True).drop_duplicates()
+        dates_df = (
+            all_df.groupby('date')['city']
+            .agg(lambda s: ';'.join(sorted(s)))
+            .reset_index()
+            .rename(columns={'city': 'datasource'})
+        )
+    else:
+        dates_df = pd.DataFrame(columns=['date', 'datasource'])
     
     # 确保输出目录存在
     output_dir = "data/processed"
@@ -46,7 +42,7 @@ def get_all_unique_dates():
     output_file = os.path.join(output_dir, "all_unique_dates.csv")
     dates_df.to_csv(output_file, index=False)
     print(f"已保存所有唯一日期到: {output_file}")
-    print(f"总共发现 {len(data_list)} 个唯一日期")
+    print(f"总共发现 {len(dates_df)} 个唯一日期")
 
 if __name__ == "__main__":
     get_all_unique_dates()
@@ -4,18 +4,34 @@ import xarray as xr
 import os
 from pathlib import Path
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# 同时向CDS提交的下载请求数上限
+ERA5_MAX_CONCURRENT_DOWNLOADS = 6
 
 def load_download_progress(progress_file):
-    """加载下载进度"""
+    """
+    加载下载进度（每行一个已下载的日期）
+    
+    只有旧版的JSON进度文件时，把其中的日期一次性写入新的进度文件，之后只读写新文件
+    """
     if os.path.exists(progress_file):
         with open(progress_file, 'r') as f:
-            return json.load(f)
-    return {'downloaded_dates': []}
+            return set(line.strip() for line in f if line.strip())
+    legacy_file = os.path.splitext(progress_file)[0] + '.json'
+    if os.path.exists(legacy_file):
+        with open(legacy_file, 'r') as f:
+            downloaded_dates = set(json.load(f)['downloaded_dates'])
+        with open(progress_file, 'w') as f:
+            f.writelines(f"{date}\n" for date in sorted(downloaded_dates))
+        return downloaded_dates
+    return set()
 
-def save_download_progress(progress_file, downloaded_dates):
-    """保存下载进度"""
-    with open(progress_file, 'w') as f:
-        json.dump({'downloaded_dates': downloaded_dates}, f)
+def append_download_progress(progress_log, date_str):
+    """在以追加模式打开的进度文件中记录一个已下载的日期，并立即落盘"""
+    progress_log.write(f"{date_str}\n")
+    progress_log.flush()
+    os.fsync(progress_log.fileno())
 
 def download_era5_rainfall(date, output_dir):
     """
@@ -72,11 +88,10 @@ def process_era5_data():
     Path(output_dir).mkdir(parents=True, exist_ok=True)
     
     # 进度文件路径
-    progress_file = os.path.join(output_dir, 'download_progress.json')
+    progress_file = os.path.join(output_dir, 'download_progress.txt')
     
     # 加载已下载的进度
-    progress = load_download_progress(progress_file)
-    downloaded_dates = set(progress['downloaded_dates'])
+    downloaded_dates = load_download_progress(progress_file)
     
     # 获取所有需要下载的日期
     all_dates = pd.to_datetime(dates_df['date'])
@@ -85,38 +100,47 @@ def process_era5_data():
     total_dates = len(all_dates)
     processed_count = 0
     
-    try:
-        for date in all_dates:
-            date_str = date.strftime('%Y-%m-%d')
+    # 筛选出需要下载的日期
+    pending_dates = []
+    for date in all_dates:
+        date_str = date.strftime('%Y-%m-%d')
+        # 如果该日期已下载，跳过
+        if date_str in downloaded_dates:
             processed_count += 1
-            
-            # 如果该日期已下载，跳过
-            if date_str in downloaded_dates:
-                print(f"跳过已下载的日期: {date_str} ({processed_count}/{total_dates})")
-                continue
-            
-            try:
-                print(f"处理日期: {date_str} ({processed_count}/{total_dates})")
-                # 下载单天数据
-                grib_file = download_era5_rainfall(date_str, output_dir)
+            continue
+        pending_dates.append(date_str)
+    print(f"跳过 {processed_count} 个已下载的日期，待下载 {len(pending_dates)} 个")
+    
+    # 下载主要在等待CDS队列，用线程并发提交请求；CDS对单个用户的并发请求数有限制，最多同时6个
+    # 进度只在主线程中更新：进度文件以追加模式打开一次，每下载成功一个日期追加一行
+    with open(progress_file, 'a') as progress_log, \
+            ThreadPoolExecutor(max_workers=ERA5_MAX_CONCURRENT_DOWNLOADS) as executor:
+        futures = {
+            executor.submit(download_era5_rainfall, date_str, output_dir): date_str
+            for date_str in pending_dates
+        }
+        
+        try:
+            for future in as_completed(futures):
+                date_str = futures[future]
+                processed_count += 1
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"下载 {date_str} 数据时发生错误: {str(e)}")
+                    continue
                 
                 # 标记为已下载
                 downloaded_dates.add(date_str)
-                save_download_progress(progress_file, list(downloaded_dates))
-                
-            except Exception as e:
-                print(f"下载 {date_str} 数据时发生错误: {str(e)}")
-                # 保存进度并继续下一个日期
-                save_download_progress(progress_file, list(downloaded_dates))
-                continue
-        
-        print("所有ERA5数据下载完成！")
-        
-    except Exception as e:
-        print(f"发生错误: {str(e)}")
-        print("已保存下载进度，下次运行时将从中断处继续")
-        # 确保在发生错误时也保存进度
-        save_download_progress(progress_file, list(downloaded_dates))
+                append_download_progress(progress_log, date_str)
+                print(f"完成日期: {date_str} ({processed_count}/{total_dates})")
+        except BaseException:
+            # 中断（如Ctrl-C）或意外错误时取消排队中的请求，不等待剩余下载完成
+            print("下载被中断，已保存的进度下次运行时将从中断处继续")
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    
+    print("所有ERA5数据下载完成！")
 
 if __name__ == "__main__":
     process_era5_data() 
\ No newline at end of file
@@ -2,16 +2,14 @@ import os
 import osmnx as ox
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import Point, box
+import shapely
+from shapely.geometry import box
 
 def get_bounding_box_from_links(links_df):
     """从links.csv中获取所有点的边界框"""
-    # 创建一个几何点列表
-    points = [Point(row['long'], row['lat']) for _, row in links_df.iterrows()]
-    # 创建GeoDataFrame
-    points_gdf = gpd.GeoDataFrame(geometry=points, crs="EPSG:4326")
-    # 获取边界框
-    minx, miny, maxx, maxy = points_gdf.total_bounds
+    # 边界框只需要经纬度的最值，无需构建点几何
+    minx, maxx = links_df['long'].min(), links_df['long'].max()
+    miny, maxy = links_df['lat'].min(), links_df['lat'].max()
     # 扩大边界框（比如扩大10%），确保包含周边道路
     dx = (maxx - minx) * 0.1
     dy = (maxy - miny) * 0.1
@@ -59,29 +57,15 @@ if __name__ == '__main__':
             roads_gdf = gpd.read_file(file_path, layer='edges')
             roads_gdf.set_crs(epsg=4326, inplace=True)
             
-            # 使用边界框筛选道路
-            selected_roads = roads_gdf[roads_gdf.geometry.intersects(bbox)].copy()
+            # 使用边界框筛选道路（边界框预处理后批量判断相交）
+            shapely.prepare(bbox)
+            mask = shapely.intersects(roads_gdf.geometry.values, bbox)
+            selected_roads = roads_gdf.loc[mask].copy()
             
             # 保存筛选后的道路数据
             selected_file_path = os.path.join(folder_name, 'selected_roads.gpkg')
             selected_roads.to_file(selected_file_path, driver='GPKG')
             print(f"Selected roads saved to {selected_file_path}")
-            
-            # 转换坐标系并保存为shp文件
-            out_dir = os.path.join(folder_name, "selected_roads_32650")
-            if not os.path.exists(out_dir):
-                os.makedirs(out_dir)
-                
-            # 转换坐标系
-            selected_roads.to_crs(epsg=32650, inplace=True)
-            
-            # 保存为shp文件
-            shp_path = os.path.join(out_dir, 'selected_roads_32650.shp')
-            if not os.path.exists(shp_path):
-                selected_roads.to_file(shp_path, driver='ESRI Shapefile')
-                print(f"Shapefile saved to {shp_path}")
-            else:
-                print(f"{city} shapefile already exists")
                 
         except Exception as e:
             print(f"Error processing {city}: {e}")
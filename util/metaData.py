@@ -2,9 +2,10 @@ import os
 import json
 import pandas as pd
 import geopandas as gpd
-import glob
 from pathlib import Path
 import numpy as np
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from datetime import datetime
 
 def generate_city_metadata(city_folder):
@@ -95,18 +96,14 @@ def generate_city_metadata(city_folder):
     # 从5min_readings.parquet获取时间点数量
     if os.path.exists(readings_parquet_path):
         try:
-            # 直接尝试读取整个文件，不使用nrows参数
-            readings_df = pd.read_parquet(readings_parquet_path)
-            
-            # 尝试找到时间列（可能是'datetime'或其他名称）
-            time_column = None
-            for potential_col in ['datetime', 'timestamp', 'time', 'date']:
-                if potential_col in readings_df.columns:
-                    time_column = potential_col
-                    break
+            # 先读取schema找到时间列（可能是'datetime'或其他名称），只加载这一列
+            schema = pq.read_schema(readings_parquet_path)
+            time_column = next((col for col in ['datetime', 'timestamp', 'time', 'date'] if col in schema.names), None)
             
             if time_column:
-                num_timepoints = readings_df[time_column].nunique()
+                time_values = pq.read_table(readings_parquet_path, columns=[time_column])[time_column]
+                # count_distinct默认不计空值，与nunique一致
+                num_timepoints = pc.count_distinct(time_values).as_py()
                 metadata["data_summary"]["num_timepoints"] = int(num_timepoints)
                 print(f"Extracted timepoint count: {num_timepoints}")
             else:
@@ -129,7 +126,8 @@ def main():
     data_root = r"data\debug\input"
     
     # 获取所有城市文件夹
-    city_folders = [d for d in glob.glob(os.path.join(data_root, "*")) if os.path.isdir(d)]
+    with os.scandir(data_root) as entries:
+        city_folders = [entry.path for entry in entries if entry.is_dir()]
     
     print(f"Found {len(city_folders)} city folders")
     
@@ -1,25 +1,168 @@
 import os
+import sys
+import errno
+import ctypes
+import ctypes.util
 import shutil
-import glob
 from pathlib import Path
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# 并行处理的城市数，以及每个城市内并行复制的文件数（复制以IO为主，使用线程）
+CITY_WORKERS = 4
+FILE_WORKERS = 8
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Linux的FICLONE ioctl：在Btrfs/XFS等文件系统上创建共享数据块的写时复制副本
+FICLONE = 0x40049409
+
+# 已确认不支持reflink的 (源设备, 目标设备) 组合，避免对每个文件重复尝试
+_reflink_unsupported = set()
+
+# 路径是否存在的缓存：路径 -> (是否存在, 记录时间)
+# 存在的结果一直有效（本脚本只会新增文件）；不存在的结果在EXISTS_CACHE_TTL秒后重新检查
+_exists_cache = {}
+EXISTS_CACHE_TTL = 5.0
+
+def _cached_exists(path):
+    """带缓存的os.path.exists，避免对同一路径反复stat"""
+    cached = _exists_cache.get(path)
+    if cached is not None and (cached[0] or time.monotonic() - cached[1] < EXISTS_CACHE_TTL):
+        return cached[0]
+    exists = os.path.exists(path)
+    _exists_cache[path] = (exists, time.monotonic())
+    return exists
+
+def _set_exists(path, exists=True):
+    """在创建、复制或移动之后直接更新缓存"""
+    _exists_cache[path] = (exists, time.monotonic())
 
 def create_directory(directory):
-    """创建目录，如果不存在"""
+    """创建目录，如果不存在；创建后目录及其所有上级目录都记为已存在"""
+    if _cached_exists(directory):
+        return
     os.makedirs(directory, exist_ok=True)
+    while directory and not _exists_cache.get(directory, (False,))[0]:
+        _set_exists(directory)
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            break
+        directory = parent
+
+def _clonefile_darwin(source, destination):
+    """macOS上用clonefile()在APFS中克隆文件，成功返回0，失败返回errno"""
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.clonefile(os.fsencode(source), os.fsencode(destination), 0) == 0:
+        return 0
+    return ctypes.get_errno()
+
+def _fast_copy(source, destination):
+    """
+    复制文件：优先reflink克隆（只复制元数据），其次在内核中复制内容（copy_file_range，失败时退回sendfile），
+    都不支持时退回普通的缓冲区复制
+    
+    复制完成后保留文件元数据，效果与shutil.copy2相同
+    """
+    devices = (os.stat(source).st_dev, os.stat(os.path.dirname(destination) or '.').st_dev)
+    
+    if sys.platform == 'darwin' and devices not in _reflink_unsupported:
+        # clonefile要求目标文件不存在；目标随后本就会被整体覆盖，先删除已有文件
+        if os.path.lexists(destination):
+            os.unlink(destination)
+        err = _clonefile_darwin(source, destination)
+        if err == 0:
+            shutil.copystat(source, destination)
+            return
+        # 只有文件系统确实不支持克隆时才对该设备组合停用reflink
+        if err in (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EXDEV):
+            _reflink_unsupported.add(devices)
+    
+    with open(source, 'rb') as fsrc, open(destination, 'wb') as fdst:
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        copied = False
+        
+        if fcntl is not None and sys.platform.startswith('linux') and devices not in _reflink_unsupported:
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                copied = True
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.EBADF):
+                    raise
+                _reflink_unsupported.add(devices)
+        
+        # copy_file_range: 数据不经过用户空间，同一文件系统上还可能由文件系统直接完成
+        if not copied and hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(src_fd, dst_fd, 1 << 30) > 0:
+                    pass
+                copied = True
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+        
+        # sendfile: 跨文件系统时仍可在内核中复制
+        if not copied and hasattr(os, 'sendfile'):
+            try:
+                offset = os.lseek(src_fd, 0, os.SEEK_CUR)
+                while True:
+                    sent = os.sendfile(dst_fd, src_fd, offset, 1 << 30)
+                    if sent == 0:
+                        break
+                    offset += sent
+                copied = True
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+        
+        if not copied:
+            # 前面的尝试可能已写入部分数据，从头重新复制
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, 4 * 1024 * 1024)
+    
+    shutil.copystat(source, destination)
 
 def copy_file(source, destination):
     """复制文件，确保目标目录存在"""
     dest_dir = os.path.dirname(destination)
     create_directory(dest_dir)
     
-    if os.path.exists(source):
-        shutil.copy2(source, destination)
+    if _cached_exists(source):
+        _fast_copy(source, destination)
+        _set_exists(destination)
         return True
     else:
         return False
 
-def organize_city_data(city_name, source_root, weather_root, target_root, copy_instead_of_move=True):
+def _process_file(source_file, dest_file, copy_instead_of_move):
+    """复制或移动单个文件，返回(是否成功, 日志信息)"""
+    try:
+        if not _cached_exists(source_file):
+            return False, f"  Warning: Source file not found: {source_file}"
+            
+        if _cached_exists(dest_file):
+            return True, f"  Skipping, already exists: {dest_file}"
+            
+        # 复制或移动文件
+        if copy_instead_of_move:
+            _fast_copy(source_file, dest_file)
+            _set_exists(dest_file)
+            return True, f"  Copied: {source_file} -> {dest_file}"
+        else:
+            shutil.move(source_file, dest_file)
+            _set_exists(dest_file)
+            _set_exists(source_file, False)
+            return True, f"  Moved: {source_file} -> {dest_file}"
+        
+    except Exception as e:
+        return False, f"  Error processing {source_file}: {str(e)}"
+
+def organize_city_data(city_name, source_root, weather_root, target_root, copy_instead_of_move=True, file_executor=None):
     """
     为单个城市组织和移动数据
     
@@ -29,11 +172,18 @@ def organize_city_data(city_name, source_root, weather_root, target_root, copy_i
     - weather_root: 天气数据根目录 (processed/ear5_city)
     - target_root: 目标根目录 (000_IUTFD)
     - copy_instead_of_move: True则复制文件，False则移动文件
+    - file_executor: 复制文件用的线程池，多个城市共用；为None时临时创建
     
     返回:
     - (成功操作的文件数, 总文件数)
     """
-    print(f"\nProcessing {city_name}...")
+    if file_executor is None:
+        with ThreadPoolExecutor(max_workers=FILE_WORKERS) as executor:
+            return organize_city_data(city_name, source_root, weather_root, target_root,
+                                      copy_instead_of_move, executor)
+    
+    # 城市之间并行处理，日志先收集再一次性输出，避免不同城市的输出交错
+    log_lines = [f"\nProcessing {city_name}..."]
     
     # 源路径
     source_city_dir = os.path.join(source_root, city_name)
@@ -47,12 +197,9 @@ def organize_city_data(city_name, source_root, weather_root, target_root, copy_i
     target_weather_dir = os.path.join(target_city_dir, "weather")
     target_datetime_dir = os.path.join(target_weather_dir, "datetime")
     
-    # 创建目标目录
-    create_directory(target_roads_dir)
-    create_directory(target_sensors_dir)
-    create_directory(target_npz_dir)
-    create_directory(target_weather_dir)
-    create_directory(target_datetime_dir)
+    # 一次性创建目标目录（只需创建最深一级，上级目录会一并创建并记入缓存）
+    for directory in (target_roads_dir, target_sensors_dir, target_npz_dir, target_datetime_dir):
+        create_directory(directory)
     
     # 定义要迁移的文件
     files_to_process = [
@@ -77,39 +224,23 @@ def organize_city_data(city_name, source_root, weather_root, target_root, copy_i
     ]
     
     # 查找并添加rainfall文件
-    if os.path.exists(weather_city_dir):
-        rainfall_files = glob.glob(os.path.join(weather_city_dir, "local_hourly_rainfall_*.parquet"))
-        for rainfall_file in rainfall_files:
-            filename = os.path.basename(rainfall_file)
-            files_to_process.append((rainfall_file, os.path.join(target_datetime_dir, filename)))
-    
-    # 处理所有文件
-    success_count = 0
-    for source_file, dest_file in files_to_process:
-        try:
-            if not os.path.exists(source_file):
-                print(f"  Warning: Source file not found: {source_file}")
-                continue
-                
-            if os.path.exists(dest_file):
-                print(f"  Skipping, already exists: {dest_file}")
-                success_count += 1
-                continue
-                
-            # 复制或移动文件
-            if copy_instead_of_move:
-                shutil.copy2(source_file, dest_file)
-                print(f"  Copied: {source_file} -> {dest_file}")
-            else:
-                shutil.move(source_file, dest_file)
-                print(f"  Moved: {source_file} -> {dest_file}")
-                
-            success_count += 1
-            
-        except Exception as e:
-            print(f"  Error processing {source_file}: {str(e)}")
+    if _cached_exists(weather_city_dir):
+        with os.scandir(weather_city_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith("local_hourly_rainfall_") and entry.name.endswith(".parquet"):
+                    files_to_process.append((entry.path, os.path.join(target_datetime_dir, entry.name)))
+    
+    # 处理所有文件：复制主要是IO，一次性把该城市的全部文件提交到线程池；结果按原顺序收集
+    futures = [
+        file_executor.submit(_process_file, source_file, dest_file, copy_instead_of_move)
+        for source_file, dest_file in files_to_process
+    ]
+    results = [future.result() for future in futures]
     
-    print(f"Completed {city_name}: {success_count}/{len(files_to_process)} files processed")
+    success_count = sum(1 for success, _ in results if success)
+    log_lines.extend(message for _, message in results)
+    log_lines.append(f"Completed {city_name}: {success_count}/{len(files_to_process)} files processed")
+    print("\n".join(log_lines))
     return success_count, len(files_to_process)
 
 def main():
@@ -125,8 +256,9 @@ def main():
     create_directory(TARGET_ROOT)
     
     # 获取城市列表
-    city_dirs = [d for d in glob.glob(os.path.join(SOURCE_ROOT, "*")) if os.path.isdir(d)]
-    city_names = [os.path.basename(d) for d in city_dirs]
+    with os.scandir(SOURCE_ROOT) as entries:
+        city_names = [entry.name for entry in entries
+                      if entry.is_dir(follow_symlinks=False) and not entry.name.startswith('.')]
     
     print(f"Found {len(city_names)} cities")
     print(f"Operation mode: {'Copy' if COPY_INSTEAD_OF_MOVE else 'Move'}")
@@ -135,10 +267,11 @@ def main():
     progress_file = os.path.join(TARGET_ROOT, "organization_progress.txt")
     
     # 从进度文件加载已处理的城市
+    # 中断后可能出现重复行，读入集合即去重
     processed_cities = set()
     if os.path.exists(progress_file):
         with open(progress_file, 'r') as f:
-            processed_cities = set(line.strip() for line in f.readlines())
+            processed_cities = set(line.strip() for line in f if line.strip())
         print(f"Loaded progress: {len(processed_cities)} cities already processed")
     
     # 记录总进度
@@ -147,38 +280,49 @@ def main():
     total_files = 0
     total_success = 0
     
-    # 处理每个城市
-    start_time = time.time()
+    # 收集待处理的城市，跳过已处理的
+    pending_cities = []
     for city_name in city_names:
         # 如果城市已处理，跳过
         if city_name in processed_cities:
             print(f"Skipping {city_name} - already processed")
             continue
+        pending_cities.append(city_name)
+    
+    # 各城市相互独立，用线程并行组织数据；所有城市共用一个复制文件的线程池
+    # 进度只在主线程中更新：进度文件以追加模式打开一次，每个成功的城市只追加一行
+    start_time = time.time()
+    with open(progress_file, 'a', buffering=1) as progress_log, \
+            ThreadPoolExecutor(max_workers=FILE_WORKERS) as file_executor, \
+            ThreadPoolExecutor(max_workers=CITY_WORKERS) as executor:
+        futures = {
+            executor.submit(
+                organize_city_data,
+                city_name,
+                SOURCE_ROOT,
+                WEATHER_ROOT,
+                TARGET_ROOT,
+                COPY_INSTEAD_OF_MOVE,
+                file_executor
+            ): city_name
+            for city_name in pending_cities
+        }
         
-        # 组织城市数据
-        success_files, total_files_city = organize_city_data(
-            city_name, 
-            SOURCE_ROOT, 
-            WEATHER_ROOT, 
-            TARGET_ROOT,
-            COPY_INSTEAD_OF_MOVE
-        )
-        
-        total_files += total_files_city
-        total_success += success_files
-        
-        # 如果成功处理，记录进度
-        if success_files > 0:
-            successful_count += 1
-            processed_cities.add(city_name)
+        for future in as_completed(futures):
+            city_name = futures[future]
+            success_files, total_files_city = future.result()
             
-            # 更新进度文件
-            with open(progress_file, 'w') as f:
-                for city in processed_cities:
-                    f.write(f"{city}\n")
-        
-        # 显示进度
-        print(f"Progress: {successful_count}/{total_cities} cities processed ({successful_count/total_cities*100:.1f}%)")
+            total_files += total_files_city
+            total_success += success_files
+            
+            # 如果成功处理，记录进度
+            if success_files > 0:
+                successful_count += 1
+                processed_cities.add(city_name)
+                progress_log.write(f"{city_name}\n")
+            
+            # 显示进度
+            print(f"Progress: {successful_count}/{total_cities} cities processed ({successful_count/total_cities*100:.1f}%)")
     
     # 显示总结
     elapsed_time = time.time() - start_time
@@ -193,7 +337,8 @@ def main():
 
 def verify_structure(target_root):
     """验证新创建的目录结构"""
-    city_dirs = [d for d in glob.glob(os.path.join(target_root, "*")) if os.path.isdir(d)]
+    with os.scandir(target_root) as entries:
+        city_dirs = [entry.path for entry in entries if entry.is_dir() and not entry.name.startswith('.')]
     
     for city_dir in city_dirs:
         city_name = os.path.basename(city_dir)
@@ -201,7 +346,7 @@ def verify_structure(target_root):
         
         # 检查元数据文件
         metadata_file = os.path.join(city_dir, f"{city_name}_metadata.json")
-        if os.path.exists(metadata_file):
+        if _cached_exists(metadata_file):
             print(f"  ✓ metadata.json: file exists")
         else:
             print(f"  ✗ metadata.json: file missing")
@@ -210,9 +355,10 @@ def verify_structure(target_root):
         subdirs = ["roads", "sensors", "npz", "weather", os.path.join("weather", "datetime")]
         for subdir in subdirs:
             full_path = os.path.join(city_dir, subdir)
-            if os.path.exists(full_path):
-                files = glob.glob(os.path.join(full_path, "*"))
-                print(f"  ✓ {subdir}: {len(files)} files")
+            if _cached_exists(full_path):
+                with os.scandir(full_path) as entries:
+                    file_count = sum(1 for entry in entries if not entry.name.startswith('.'))
+                print(f"  ✓ {subdir}: {file_count} files")
             else:
                 print(f"  ✗ {subdir}: directory missing")
 
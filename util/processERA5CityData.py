@@ -14,7 +14,7 @@ warnings.filterwarnings('ignore')
 # Import custom modules
 sys.path.append('.')  # Ensure the current directory is in the path
 from util.TimeConverter import TimeConverter
-from util.getERA5Data import download_era5_rainfall, load_download_progress, save_download_progress
+from util.getERA5Data import download_era5_rainfall, load_download_progress, append_download_progress
 
 class ERA5CityProcessor:
     def __init__(self, city_name, era5_root="G:/002_Data/007_ERA5/000_weather", 
@@ -417,30 +417,30 @@ class ERA5CityProcessor:
     def _download_missing_era5_data(self, missing_dates):
         """下载缺失的ERA5数据"""
         # 进度文件路径
-        progress_file = self.era5_root / 'download_progress.json'
+        progress_file = self.era5_root / 'download_progress.txt'
         
         # 加载已下载的进度
-        progress = load_download_progress(str(progress_file))
-        downloaded_dates = set(progress['downloaded_dates'])
-        
-        for date_str in missing_dates:
-            # 如果该日期已下载，跳过
-            if date_str in downloaded_dates:
-                print(f"跳过已下载的日期: {date_str}")
-                continue
-            
-            try:
-                print(f"下载日期: {date_str} 的ERA5数据")
-                # 下载单天数据
-                download_era5_rainfall(date_str, str(self.era5_root))
-                
-                # 标记为已下载
-                downloaded_dates.add(date_str)
-                save_download_progress(str(progress_file), list(downloaded_dates))
+        downloaded_dates = load_download_progress(str(progress_file))
+        
+        with open(progress_file, 'a') as progress_log:
+            for date_str in missing_dates:
+                # 如果该日期已下载，跳过
+                if date_str in downloaded_dates:
+                    print(f"跳过已下载的日期: {date_str}")
+                    continue
                 
-            except Exception as e:
-                print(f"下载 {date_str} 数据时发生错误: {str(e)}")
-                continue
+                try:
+                    print(f"下载日期: {date_str} 的ERA5数据")
+                    # 下载单天数据
+                    download_era5_rainfall(date_str, str(self.era5_root))
+                    
+                    # 标记为已下载
+                    downloaded_dates.add(date_str)
+                    append_download_progress(progress_log, date_str)
+                    
+                except Exception as e:
+                    print(f"下载 {date_str} 数据时发生错误: {str(e)}")
+                    continue
     
     def get_era5_data_for_local_date(self, local_date):
         """处理指定本地日期的数据"""
@@ -595,90 +595,108 @@ class ERA5CityProcessor:
             # 提取该时间点的数据切片
             time_slice = ds_rain.sel(time=closest_time)
             
-            # 收集所有网格的数据
-            grid_data = []
+            # 读取降水类型数据 (edition 2)，在网格循环外只打开一次
+            try:
+                ds_type = xr.open_dataset(grib_file, engine='cfgrib',
+                                        backend_kwargs={'filter_by_keys': {'edition': 2}})
+            except Exception as e:
+                ds_type = None
             
-            for _, grid_cell in grid_info.iterrows():
-                # 获取该网格的数据
-                cell_data = time_slice.sel(
-                    longitude=grid_cell.longitude,
-                    latitude=grid_cell.latitude,
-                    method='nearest'
-                )
+            # 降水类型数据集在任何情况下都要关闭，避免异常时泄漏cfgrib文件句柄
+            try:
+                # 目标UTC时间只需设置一次时区
+                utc_time_aware = utc_time.tz_localize('UTC')
                 
-                # 获取降水类型数据
-                try:
-                    ds_type = xr.open_dataset(grib_file, engine='cfgrib',
-                                            backend_kwargs={'filter_by_keys': {'edition': 2}})
-                    type_data = ds_type.sel(
-                        time=closest_time,
-                        longitude=grid_cell.longitude,
-                        latitude=grid_cell.latitude,
+                # 收集所有网格的数据
+                grid_data = []
+                
+                # 按列取出网格属性，避免iterrows逐行构造Series
+                grid_ids = grid_info['grid_id'].to_numpy()
+                grid_lons = grid_info['longitude'].to_numpy()
+                grid_lats = grid_info['latitude'].to_numpy()
+                
+                for grid_id, lon, lat in zip(grid_ids, grid_lons, grid_lats):
+                    # 获取该网格的数据
+                    cell_data = time_slice.sel(
+                        longitude=lon,
+                        latitude=lat,
                         method='nearest'
                     )
-                    # print("type_data")
-                    # print(type_data.ptype.values)
                     
-                    if hasattr(type_data, 'ptype'):
-                        if type_data.ptype.values.size > hour_offset:
-                            precip_type = float(type_data.ptype.values[hour_offset])
-                            if np.isnan(precip_type):
-                                precip_type = 0
-                        elif type_data.ptype.values.size == 1:
-                            precip_type = float(type_data.ptype.values.item())
+                    # 获取降水类型数据
+                    try:
+                        if ds_type is None:
+                            raise ValueError("无法读取降水类型数据")
+                        type_data = ds_type.sel(
+                            time=closest_time,
+                            longitude=lon,
+                            latitude=lat,
+                            method='nearest'
+                        )
+                        # print("type_data")
+                        # print(type_data.ptype.values)
+                        
+                        if hasattr(type_data, 'ptype'):
+                            if type_data.ptype.values.size > hour_offset:
+                                precip_type = float(type_data.ptype.values[hour_offset])
+                                if np.isnan(precip_type):
+                                    precip_type = 0
+                            elif type_data.ptype.values.size == 1:
+                                precip_type = float(type_data.ptype.values.item())
+                            else:
+                                print(f"警告: type_data.ptype.values大小({type_data.ptype.values.size})小于小时偏移({hour_offset})")
+                                precip_type = 0.0
                         else:
-                            print(f"警告: type_data.ptype.values大小({type_data.ptype.values.size})小于小时偏移({hour_offset})")
-                            precip_type = 0.0
-                    else:
+                            precip_type = -1
+                    except Exception as e:
                         precip_type = -1
-                        
-                    ds_type.close()
-                except Exception as e:
-                    precip_type = -1
-                
-                # 安全地提取tp和lsrr值 - 考虑到数组形式的数据
-                try:
-                    # 处理tp值 - 使用计算出的小时偏移
-                    if hasattr(cell_data, 'tp'):
-                        tp_values = cell_data.tp.values
-                        if tp_values.size > hour_offset:
-                            tp_value = float(tp_values[hour_offset])
-                        elif tp_values.size == 1:
-                            tp_value = float(tp_values.item())
+                    
+                    # 安全地提取tp和lsrr值 - 考虑到数组形式的数据
+                    try:
+                        # 处理tp值 - 使用计算出的小时偏移
+                        if hasattr(cell_data, 'tp'):
+                            tp_values = cell_data.tp.values
+                            if tp_values.size > hour_offset:
+                                tp_value = float(tp_values[hour_offset])
+                            elif tp_values.size == 1:
+                                tp_value = float(tp_values.item())
+                            else:
+                                print(f"警告: tp_values大小({tp_values.size})小于小时偏移({hour_offset})")
+                                tp_value = 0.0
                         else:
-                            print(f"警告: tp_values大小({tp_values.size})小于小时偏移({hour_offset})")
                             tp_value = 0.0
-                    else:
-                        tp_value = 0.0
-                    
-                    # 处理lsrr值 - 使用计算出的小时偏移
-                    if hasattr(cell_data, 'lsrr'):
-                        lsrr_values = cell_data.lsrr.values
-                        if lsrr_values.size > hour_offset:
-                            lsrr_value = float(lsrr_values[hour_offset])
-                        elif lsrr_values.size == 1:
-                            lsrr_value = float(lsrr_values.item())
+                        
+                        # 处理lsrr值 - 使用计算出的小时偏移
+                        if hasattr(cell_data, 'lsrr'):
+                            lsrr_values = cell_data.lsrr.values
+                            if lsrr_values.size > hour_offset:
+                                lsrr_value = float(lsrr_values[hour_offset])
+                            elif lsrr_values.size == 1:
+                                lsrr_value = float(lsrr_values.item())
+                            else:
+                                print(f"警告: lsrr_values大小({lsrr_values.size})小于小时偏移({hour_offset})")
+                                lsrr_value = 0.0
                         else:
-                            print(f"警告: lsrr_values大小({lsrr_values.size})小于小时偏移({hour_offset})")
                             lsrr_value = 0.0
-                    else:
+                    
+                    except Exception as e:
+                        print(f"提取降水数据时出错: {str(e)}")
+                        tp_value = 0.0
                         lsrr_value = 0.0
-                
-                except Exception as e:
-                    print(f"提取降水数据时出错: {str(e)}")
-                    tp_value = 0.0
-                    lsrr_value = 0.0
-                
-                # 添加到结果中
-                grid_data.append({
-                    'utc_time': utc_time.tz_localize('UTC'),  # 使用原始的目标UTC时间
-                    'grid_id': grid_cell.grid_id,
-                    'longitude': grid_cell.longitude,
-                    'latitude': grid_cell.latitude,
-                    'total_precipitation': tp_value if not np.isnan(tp_value) else 0.0,
-                    'large_scale_rain_rate': lsrr_value if not np.isnan(lsrr_value) else 0.0,
-                    'precipitation_type': precip_type
-                })
+                    
+                    # 添加到结果中
+                    grid_data.append({
+                        'utc_time': utc_time_aware,  # 使用原始的目标UTC时间
+                        'grid_id': grid_id,
+                        'longitude': lon,
+                        'latitude': lat,
+                        'total_precipitation': tp_value if not np.isnan(tp_value) else 0.0,
+                        'large_scale_rain_rate': lsrr_value if not np.isnan(lsrr_value) else 0.0,
+                        'precipitation_type': precip_type
+                    })
+            finally:
+                if ds_type is not None:
+                    ds_type.close()
             
             # 创建数据框
             return pd.DataFrame(grid_data)